@@ -0,0 +1,199 @@
+# Copyright (c) 2014 Thomas Scholtes
+
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+"""Hashing and checksum manifests for the check plugin.
+
+This module must not import beets so that `beets-check-verify` starts
+quickly on hosts without a beets installation.
+"""
+
+import json
+import os
+import re
+import threading
+from hashlib import blake2b, sha256
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Hash algorithms by name. Checksums computed with an algorithm other than
+# `sha256` are stored with the algorithm name as a prefix, e.g. `blake2b:8f3a…`.
+ALGORITHMS = {"sha256": sha256, "blake2b": blake2b}
+if xxhash:
+    ALGORITHMS["xxh3"] = xxhash.xxh3_128
+if blake3:
+    ALGORITHMS["blake3"] = blake3.blake3
+
+DEFAULT_ALGORITHM = "sha256"
+
+
+def parse_checksum(checksum):
+    """Split a stored checksum into the algorithm name and the hex digest.
+
+    Checksums without a prefix were computed with sha256.
+    """
+    algorithm, sep, digest = checksum.rpartition(":")
+    if not sep:
+        return DEFAULT_ALGORITHM, checksum
+    return algorithm, digest
+
+
+def format_checksum(algorithm, digest):
+    # sha256 checksums are stored without a prefix to stay compatible with
+    # checksums stored by earlier versions and with `sha256sum`.
+    if algorithm == DEFAULT_ALGORITHM:
+        return digest
+    return f"{algorithm}:{digest}"
+
+
+_thread_buffers = threading.local()
+
+
+def thread_buffer(size):
+    """Return a buffer of `size` bytes that is reused by the current thread."""
+    buffer = getattr(_thread_buffers, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = _thread_buffers.buffer = bytearray(size)
+    return buffer
+
+
+def read_chunks(path, buffer_size, watch=None):
+    """Read the file into the buffer of the current thread and yield the
+    chunks that were read.
+
+    A chunk is only valid until the next one is read. If a stopwatch is given
+    the time spent opening and reading the file is added to its `open` and
+    `read` phases.
+    """
+    buffer = thread_buffer(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        if watch:
+            watch.lap("open")
+        while size := file.readinto(buffer):
+            if watch:
+                watch.lap("read")
+            yield view[:size]
+
+
+def hash_chunks(chunks, hashes, watch=None):
+    """Update each of the hashes with the chunks and return the hex digests.
+
+    If a stopwatch is given the time spent hashing is added to its `hash`
+    phase.
+    """
+    for chunk in chunks:
+        for hash in hashes:
+            hash.update(chunk)
+        if watch:
+            watch.lap("hash")
+    return [hash.hexdigest() for hash in hashes]
+
+
+def hash_file(path, algorithms, buffer_size):
+    """Return the hex digests of the file for each of the given algorithms.
+
+    The file is read once into the buffer of the current thread.
+    """
+    hashes = [ALGORITHMS[algorithm]() for algorithm in algorithms]
+    return hash_chunks(read_chunks(path, buffer_size), hashes)
+
+
+# Names of the algorithms in the BSD format used by `sha256sum --tag`
+BSD_NAMES = {
+    "sha256": "SHA256",
+    "blake2b": "BLAKE2b",
+    "xxh3": "XXH3",
+    "blake3": "BLAKE3",
+}
+
+# Lines of checksum manifests
+GNU_MANIFEST_LINE = re.compile(rb"(\\?)([0-9a-fA-F]+) [ *](.+)")
+BSD_MANIFEST_LINE = re.compile(rb"(\\?)([\w-]+) \((.+)\) = ([0-9a-fA-F]+)")
+
+# Algorithms of GNU style manifests by the length of the hex digest
+GNU_ALGORITHMS = {64: "sha256", 128: "blake2b"}
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def parse_manifest(file):
+    """Yield the path and the checksum of each line of a manifest from a
+    binary file.
+
+    Manifests are in the format of `sha256sum`, of `sha256sum --tag` (BSD) or
+    JSON Lines as written by `beet check --export`. Checksums are formatted
+    like the checksums stored in the library. For invalid lines and lines
+    with unsupported algorithms a `ManifestError` is yielded instead of
+    raised so that the remaining lines can still be read.
+    """
+    bsd_algorithms = {name.lower(): algorithm for algorithm, name in BSD_NAMES.items()}
+    for number, line in enumerate(file, 1):
+        line = line.rstrip(b"\r\n")
+        if not line:
+            continue
+        escaped = False
+        if line.startswith(b"{"):
+            try:
+                record = json.loads(line)
+                path = os.fsencode(record["path"])
+                algorithm = str(record["algorithm"])
+                digest = record["checksum"].encode("ascii")
+            except (ValueError, KeyError, TypeError, AttributeError):
+                yield ManifestError(f"invalid manifest line {number}")
+                continue
+        elif match := BSD_MANIFEST_LINE.fullmatch(line):
+            escaped, name, path, digest = match.groups()
+            algorithm = bsd_algorithms.get(name.decode("ascii").lower())
+        elif match := GNU_MANIFEST_LINE.fullmatch(line):
+            escaped, digest, path = match.groups()
+            algorithm = GNU_ALGORITHMS.get(len(digest))
+        else:
+            yield ManifestError(f"invalid manifest line {number}")
+            continue
+        if algorithm not in ALGORITHMS:
+            yield ManifestError(
+                f"unsupported checksum algorithm in manifest line {number}"
+            )
+            continue
+        if escaped:
+            path = unescape_manifest_path(path)
+        yield path, format_checksum(algorithm, digest.decode("ascii").lower())
+
+
+def escape_manifest_path(path):
+    """Escape backslashes and line breaks in a file name like `sha256sum`.
+
+    Returns the prefix of the line, which is a backslash if the name was
+    escaped, and the escaped name.
+    """
+    if "\\" not in path and "\n" not in path and "\r" not in path:
+        return "", path
+    path = path.replace("\\", "\\\\").replace("\n", "\\n").replace("\r", "\\r")
+    return "\\", path
+
+
+def unescape_manifest_path(path):
+    """Undo the escaping of backslashes and line breaks in the file names of
+    `sha256sum`.
+    """
+    escapes = {b"\\\\": b"\\", b"\\n": b"\n", b"\\r": b"\r"}
+    return re.sub(rb"\\[\\nr]", lambda match: escapes[match.group()], path)
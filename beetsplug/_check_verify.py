@@ -0,0 +1,174 @@
+# Copyright (c) 2014 Thomas Scholtes
+
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+"""The `beets-check-verify` command.
+
+Verifies files against a manifest written by `beet check --export` without
+loading beets or its configuration.
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+from collections import deque
+from concurrent import futures
+
+from beetsplug._check_hash import (
+    ManifestError,
+    hash_file,
+    parse_checksum,
+    parse_manifest,
+)
+
+READ_BUFFER = 1024 * 1024
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="beets-check-verify",
+        description="Verify files against a checksum manifest written by "
+        "`beet check --export`. Exits with status code 15 if at least one "
+        "file does not match, if the manifest has invalid lines or if it "
+        "lists no files.",
+    )
+    parser.add_argument(
+        "manifest",
+        metavar="MANIFEST",
+        help="manifest in the format of sha256sum, sha256sum --tag or JSON "
+        "Lines, `-` reads stdin",
+    )
+    parser.add_argument(
+        "--root",
+        metavar="DIR",
+        help="directory of relative paths in the manifest "
+        "(default: the directory of the manifest)",
+    )
+    parser.add_argument(
+        "--rewrite-prefix",
+        metavar="OLD=NEW",
+        action="append",
+        default=[],
+        help="replace the prefix OLD of the paths in the manifest with NEW, "
+        "can be given more than once",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count(),
+        help="number of files to verify in parallel (default: number of CPUs)",
+    )
+    options = parser.parse_args(args)
+    if options.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    rewrites = []
+    for value in options.rewrite_prefix:
+        old, sep, new = value.partition("=")
+        if not sep or not old:
+            parser.error(f"invalid prefix rewrite {value}, expected OLD=NEW")
+        rewrites.append((os.fsencode(old), os.fsencode(new)))
+
+    with contextlib.ExitStack() as stack:
+        if options.manifest == "-":
+            file = sys.stdin.buffer
+            root = os.getcwd()
+        else:
+            try:
+                file = stack.enter_context(open(options.manifest, "rb"))
+            except OSError as exc:
+                parser.exit(2, f"{parser.prog}: error: {exc}\n")
+            root = os.path.dirname(os.path.abspath(options.manifest))
+        if options.root:
+            root = options.root
+        files, failures, invalid = verify_manifest(
+            file, os.fsencode(root), rewrites, options.threads
+        )
+
+    if failures:
+        echo(f"Failed to verify checksum of {failures} file(s)")
+    elif invalid:
+        echo(f"Failed to read {invalid} line(s) of the manifest")
+    elif not files:
+        echo("No files to verify in the manifest")
+    else:
+        echo("All checksums successfully verified")
+        return
+    sys.exit(15)
+
+
+def verify_manifest(file, root, rewrites, threads):
+    """Verify the files of the manifest.
+
+    Returns the number of files, the number of files that failed and the
+    number of invalid lines. Files are verified by `threads` threads while the
+    manifest is read. Results are printed in the order of the manifest.
+    """
+    files = 0
+    failures = 0
+    invalid = 0
+
+    def entries():
+        nonlocal invalid
+        for entry in parse_manifest(file):
+            if isinstance(entry, ManifestError):
+                echo(f"WARNING {entry}", sys.stderr)
+                invalid += 1
+                continue
+            path, checksum = entry
+            for old, new in rewrites:
+                if path.startswith(old):
+                    path = new + path[len(old) :]
+                    break
+            yield os.path.join(root, path), checksum
+
+    with futures.ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        for path, checksum in entries():
+            pending.append((path, executor.submit(verify_file, path, checksum)))
+            files += 1
+            # Bound the number of queued files so that the manifest is
+            # streamed instead of read up front.
+            if len(pending) >= threads * 4:
+                failures += report(*pending.popleft())
+        while pending:
+            failures += report(*pending.popleft())
+
+    if invalid:
+        echo(f"Skipped {invalid} invalid line(s)", sys.stderr)
+    return files, failures, invalid
+
+
+def verify_file(path, checksum):
+    """Return whether the file matches the checksum."""
+    algorithm, digest = parse_checksum(checksum)
+    return hash_file(path, [algorithm], READ_BUFFER)[0] == digest
+
+
+def report(path, future):
+    """Print the result of verifying the file and return 1 if it failed."""
+    try:
+        if future.result():
+            return 0
+        echo(f"FAILED: {os.fsdecode(path)}")
+    except OSError as exc:
+        echo(f"ERROR {exc}")
+    return 1
+
+
+def echo(message, file=None):
+    file = file or sys.stdout
+    file.write(message.encode(errors="replace").decode() + "\n")
+
+
+if __name__ == "__main__":
+    main()
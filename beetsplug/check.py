@@ -11,10 +11,29 @@
 # all copies or substantial portions of the Software.
 
 
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import csv
+import itertools
+import json
+import operator
 import os
+import pstats
+import queue
 import re
+import shlex
 import shutil
+import signal
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, defaultdict, deque
 from collections.abc import MutableSequence
 from concurrent import futures
 from hashlib import sha256
@@ -23,10 +42,24 @@ from subprocess import PIPE, STDOUT, Popen, check_call
 
 import beets
 from beets import config, logging
-from beets.library import Item, ReadError
+from beets.dbcore.query import FixedFieldSort, MatchQuery, OrQuery
+from beets.library import Item, ReadError, parse_query_parts
 from beets.plugins import BeetsPlugin
 from beets.ui import Subcommand, UserError, colorize, decargs, input_yn
-from beets.util import displayable_path, syspath
+from beets.util import bytestring_path, displayable_path, normpath, syspath
+
+from beetsplug._check_hash import (
+    ALGORITHMS,
+    BSD_NAMES,
+    DEFAULT_ALGORITHM,
+    ManifestError,
+    escape_manifest_path,
+    format_checksum,
+    hash_chunks,
+    parse_checksum,
+)
+from beetsplug._check_hash import parse_manifest as parse_manifest_entries
+from beetsplug._check_hash import read_chunks as read_file_chunks
 
 try:
     from beets.importer import Action as ImporterAction
@@ -34,29 +67,452 @@ except ImportError:
     # beets<2.4 compatibility
     from beets.importer import action as ImporterAction
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
 log = logging.getLogger("beets.check")
 
 
 def set_checksum(item):
-    item["checksum"] = compute_checksum(item)
+    assign_checksum(item)
     item.store()
 
 
-def compute_checksum(item):
-    hash = sha256()
-    with open(syspath(item.path), "rb") as file:  # noqa: FURB101
-        hash.update(file.read())
-    return hash.hexdigest()
+def assign_checksum(item):
+    """Compute the checksum of the item's file and assign it to the item
+    without storing it.
+    """
+    stat = os.stat(syspath(item.path))
+    item["checksum"] = compute_checksum(item)
+    record_stat(item, stat)
+    mark_verified(item)
+
+
+def record_stat(item, stat):
+    """Remember the file metadata that belongs to the item's checksum."""
+    # Flexible attributes are stored as text and SQLite would round floats to
+    # 15 digits. We store exact string representations instead.
+    item["checksum_mtime"] = str(stat.st_mtime)
+    item["checksum_size"] = str(stat.st_size)
+    item["checksum_inode"] = str(stat.st_ino)
+
+
+def mark_verified(item):
+    """Record that the item's checksum matched its file just now."""
+    item["checksum_verified_at"] = str(int(time.time()))
+
+
+def verified_at(item):
+    """Return the time the item's checksum was last verified or 0."""
+    try:
+        return float(item["checksum_verified_at"])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def path_from_sql(value):
+    """Convert a value of the `path` column like beets does when it loads
+    an item.
+    """
+    return Item._fields["path"].from_sql(value)
+
+
+def file_size(item):
+    """Return the size of the item's file as recorded with its checksum or
+    from the file system. Returns 0 if the file does not exist.
+    """
+    size = item.get("checksum_size", None)
+    if size is not None:
+        return int(size)
+    try:
+        return os.stat(syspath(item.path)).st_size
+    except OSError:
+        return 0
+
+
+def stat_matches(item, stat):
+    """Return `True` if `stat` matches the file metadata recorded for the
+    item's checksum.
+
+    If this is the case the file is assumed to be unchanged since the checksum
+    was computed.
+    """
+    try:
+        return (
+            float(item["checksum_mtime"]) == stat.st_mtime
+            and int(item["checksum_size"]) == stat.st_size
+            and int(item["checksum_inode"]) == stat.st_ino
+        )
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def compute_checksum(item, algorithm=None):
+    """Compute the checksum of the item's file.
+
+    Uses the configured algorithm unless `algorithm` is given.
+    """
+    if algorithm is None:
+        algorithm = config["check"]["algorithm"].as_str()
+    (digest,) = hash_file(syspath(item.path), [algorithm])
+    return format_checksum(algorithm, digest)
+
+
+def hash_file(path, algorithms):
+    """Return the hex digests of the file for each of the given algorithms.
+
+    The file is read only once, regardless of the number of algorithms.
+    """
+    hashes = [new_hash(algorithm) for algorithm in algorithms]
+    watch = Stopwatch()
+    return hash_chunks(read_chunks(path, watch), hashes, watch)
+
+
+def read_chunks(path, watch=None):
+    """Read the file into the buffer of the current thread and yield the
+    chunks that were read.
+
+    Like `read_file_chunks()` but uses the configured buffer size and
+    adds the number of bytes read to the current result.
+    """
+    result = current_result.get()
+    for chunk in read_file_chunks(path, read_buffer_size(), watch):
+        if result is not None:
+            result["bytes"] += len(chunk)
+        yield chunk
+
+
+# The result of the item that the current worker processes. Set by
+# `CheckCommand` when a report is written. Context variables are local to
+# threads and follow asyncio tasks.
+current_result = contextvars.ContextVar("current_result", default=None)
+
+
+def new_result():
+    return {
+        "status": None,
+        "reason": None,
+        "checker": None,
+        "bytes": 0,
+        "durations": {},
+    }
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the block to the durations of the current
+    result.
+    """
+    result = current_result.get()
+    if result is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations = result["durations"]
+        durations[name] = durations.get(name, 0) + time.perf_counter() - start
+
+
+class Stopwatch:
+    """Splits the time spent on a file among the phases of the current
+    result.
+
+    Each call of `lap()` adds the time since the previous call to the given
+    phase. Does nothing if no result is recorded.
+    """
+
+    def __init__(self):
+        result = current_result.get()
+        self.durations = result["durations"] if result is not None else None
+        self.last = time.perf_counter()
+
+    def __bool__(self):
+        return self.durations is not None
+
+    def lap(self, name):
+        if self.durations is None:
+            return
+        now = time.perf_counter()
+        self.durations[name] = self.durations.get(name, 0) + now - self.last
+        self.last = now
+
+
+# The `Profile` of the current run if `--profile` is given
+active_profile = None
+
+
+@contextlib.contextmanager
+def profiled(name):
+    """Add the time spent in the block to the phase of the active profile.
+
+    This is used for work that does not belong to the result of an item.
+    """
+    profile = active_profile
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+
+def profiled_iter(iterable, name):
+    """Yield the values of `iterable` and profile the time it takes to
+    produce each one.
+    """
+    iterator = iter(iterable)
+    while True:
+        with profiled(name):
+            value = next(iterator, profiled_iter)
+        if value is profiled_iter:
+            return
+        yield value
+
+
+def new_hash(algorithm):
+    try:
+        return ALGORITHMS[algorithm]()
+    except KeyError:
+        raise UserError(f"unsupported checksum algorithm {algorithm}") from None
+
+
+def read_buffer_size():
+    """Return the size of the buffer for reading files.
+
+    Each thread reuses its buffer for every file it reads so that memory usage
+    is bounded by `threads x read_buffer` regardless of the file sizes.
+    """
+    size = config["check"]["read_buffer"].get(int)
+    if size <= 0:
+        raise UserError("check.read_buffer must be a positive number of bytes")
+    return size
 
 
 def verify_checksum(item):
-    if item["checksum"] != compute_checksum(item):
+    algorithm, digest = parse_checksum(item["checksum"])
+    if algorithm not in ALGORITHMS:
+        raise ChecksumError(item.path, f"unsupported checksum algorithm {algorithm}")
+    if digest != hash_file(syspath(item.path), [algorithm])[0]:
         raise ChecksumError(item.path, "checksum did not match value in library.")
 
 
+def verify_checksum_quick(item):
+    """Verify the checksum only if the file metadata changed.
+
+    If the checksum is verified the new file metadata is recorded on the item
+    so that the next quick check does not read the file again. Returns `True`
+    if the item needs to be stored.
+    """
+    stat = os.stat(syspath(item.path))
+    if stat_matches(item, stat):
+        return False
+    verify_checksum(item)
+    record_stat(item, stat)
+    mark_verified(item)
+    return True
+
+
 def verify_integrity(item):
-    for checker in IntegrityChecker.allAvailable():
-        checker.check(item)
+    for checker in IntegrityChecker.checking():
+        with phase(checker.name):
+            try:
+                checker.check(item)
+            except IntegrityError as exc:
+                exc.checker = exc.checker or checker.name
+                raise
+
+
+async def verify_integrity_async(item, processes=None, cache=False):
+    """Like `verify_integrity` but runs external tools without blocking a
+    thread while they run.
+
+    `processes` is an optional semaphore that limits the number of tools
+    running at the same time.
+
+    The result of each checker is recorded on the item (see
+    `record_verdict`) without storing it. If `cache` is true, checkers whose
+    result for the unchanged file is recorded are not run again.
+    """
+    stat = os.stat(syspath(item.path)) if item.get("checksum", None) else None
+    for checker in IntegrityChecker.checking():
+        cacheable = (
+            stat is not None
+            and hasattr(checker, "fingerprint")
+            and checker.can_check(item)
+        )
+        if cache and cacheable:
+            verdict = cached_verdict(item, checker, stat)
+            if verdict is not None:
+                if verdict:
+                    exc = IntegrityError(item.path, verdict)
+                    exc.checker = checker.name
+                    raise exc
+                continue
+        try:
+            with phase(checker.name):
+                if hasattr(checker, "check_async"):
+                    await checker.check_async(item, processes)
+                else:
+                    await asyncio.to_thread(checker.check, item)
+        except IntegrityError as exc:
+            exc.checker = exc.checker or checker.name
+            if cacheable:
+                record_verdict(item, checker, stat, exc.reason)
+            raise
+        if cacheable:
+            record_verdict(item, checker, stat, None)
+
+
+def cached_verdict(item, checker, stat):
+    """Return the recorded result of the checker for the item.
+
+    Returns `None` if there is no result for the current version of the
+    checker, the item's checksum and the file metadata in `stat`. Otherwise
+    returns the reason of the integrity error or `""` if the check passed.
+    """
+    try:
+        verdicts = json.loads(item["integrity_verdicts"])
+        entry = verdicts[checker.name]
+    except (KeyError, TypeError, ValueError):
+        return None
+    if entry[:-1] != verdict_key(item, checker, stat):
+        return None
+    return entry[-1] or ""
+
+
+def record_verdict(item, checker, stat, reason):
+    """Record the result of the checker for the item's file without storing
+    the item.
+
+    `reason` is the reason of the integrity error or `None` if the check
+    passed. Results are stored as JSON in the `integrity_verdicts` field.
+    """
+    try:
+        verdicts = json.loads(item["integrity_verdicts"])
+    except (KeyError, TypeError, ValueError):
+        verdicts = {}
+    verdicts[checker.name] = [*verdict_key(item, checker, stat), reason]
+    item["integrity_verdicts"] = json.dumps(verdicts, sort_keys=True)
+
+
+def verdict_key(item, checker, stat):
+    return [
+        checker.fingerprint(),
+        item["checksum"],
+        str(stat.st_mtime),
+        stat.st_size,
+        stat.st_ino,
+    ]
+
+
+def verify_all(item, checkers=None):
+    """Verify the checksum and the integrity of the item reading its file
+    only once.
+
+    Every chunk that is read is passed to the hasher, to the built-in checkers
+    and to the stdin of external tools configured with `stdin`. Other tools
+    are run on the file afterwards. `checkers` defaults to all available
+    checkers. Returns the list of `ChecksumError` and `IntegrityError`
+    exceptions.
+    """
+    if checkers is None:
+        checkers = IntegrityChecker.checking()
+    errors = []
+    hash = digest = None
+    if item.get("checksum", None):
+        algorithm, digest = parse_checksum(item["checksum"])
+        if algorithm in ALGORITHMS:
+            hash = new_hash(algorithm)
+        else:
+            errors.append(
+                ChecksumError(item.path, f"unsupported checksum algorithm {algorithm}")
+            )
+
+    streams = []
+    others = []
+    for checker in checkers:
+        if hasattr(checker, "stream"):
+            if not checker.can_check(item):
+                continue
+            stream = checker.stream(item)
+            if stream is not None:
+                streams.append((checker, stream))
+                continue
+        others.append(checker)
+
+    def stream_failed(checker, stream, exc):
+        streams.remove((checker, stream))
+        if isinstance(exc, FormatError):
+            exc = IntegrityError(item.path, str(exc))
+        exc.checker = checker.name
+        errors.append(exc)
+
+    watch = Stopwatch()
+    try:
+        # Without a hasher and streams there is nothing to read the file for
+        chunks = read_chunks(syspath(item.path), watch) if hash or streams else ()
+        for chunk in chunks:
+            if hash:
+                hash.update(chunk)
+                watch.lap("hash")
+            for checker, stream in list(streams):
+                try:
+                    stream.update(chunk)
+                except (FormatError, IntegrityError) as exc:
+                    stream_failed(checker, stream, exc)
+                watch.lap(checker.name)
+            if not hash and not streams:
+                break
+        for checker, stream in list(streams):
+            try:
+                stream.finish()
+            except (FormatError, IntegrityError) as exc:
+                stream_failed(checker, stream, exc)
+            watch.lap(checker.name)
+    finally:
+        for _, stream in streams:
+            if hasattr(stream, "close"):
+                stream.close()
+
+    if hash and hash.hexdigest() != digest:
+        errors.append(
+            ChecksumError(item.path, "checksum did not match value in library.")
+        )
+    for checker in others:
+        try:
+            with phase(checker.name):
+                checker.check(item)
+        except IntegrityError as exc:
+            exc.checker = exc.checker or checker.name
+            errors.append(exc)
+    return errors
+
+
+def flush_integrity_batches():
+    """Start running the pending batches of all checkers that check multiple
+    files with one invocation.
+    """
+    for checker in IntegrityChecker.checking():
+        if getattr(checker, "batch", None):
+            checker.flush()
+
+
+def integrity_batch_waiters():
+    """Return the number of items that wait for a batch that has not been
+    started yet.
+    """
+    return sum(
+        checker.waiting()
+        for checker in IntegrityChecker.checking()
+        if getattr(checker, "batch", None)
+    )
 
 
 class ChecksumError(ReadError):
@@ -75,6 +531,13 @@ class CheckPlugin(BeetsPlugin):
             "integrity": True,
             "convert-update": True,
             "threads": os.cpu_count(),
+            "external_concurrency": os.cpu_count(),
+            "read_buffer": 1024 * 1024,
+            "algorithm": DEFAULT_ALGORITHM,
+            "commit_batch": 1000,
+            "commit_interval": 5,
+            "per_device_threads": 0,
+            "devices": [],
             "external": {
                 "mp3val": {
                     "cmdline": "mp3val {0}",
@@ -85,6 +548,7 @@ class CheckPlugin(BeetsPlugin):
                 "flac": {
                     # More aggressive check by default
                     "cmdline": "flac --test --silent --warnings-as-errors {0}",
+                    "stdin": "flac --test --silent --warnings-as-errors -",
                     "formats": "FLAC",
                     "error": "^.*: (?:WARNING|ERROR),? (.*)$",
                     # Recodes and fixes errors
@@ -92,6 +556,7 @@ class CheckPlugin(BeetsPlugin):
                 },
                 "oggz-validate": {"cmdline": "oggz-validate {0}", "formats": "OGG"},
             },
+            "builtin": ["mp3", "ogg"],
         })
 
         if self.config["import"]:
@@ -194,7 +659,26 @@ class CheckPlugin(BeetsPlugin):
 class CheckCommand(Subcommand):
     def __init__(self, config):
         self.threads = config["threads"].get(int)
+        self.external_concurrency = config["external_concurrency"].get(int)
+        self.commit_batch = config["commit_batch"].get(int)
+        self.commit_interval = config["commit_interval"].as_number()
+        self.per_device_threads = config["per_device_threads"].get(int)
+        # Longest prefixes first so that nested mount points match first
+        self.device_prefixes = sorted(
+            (
+                os.path.join(normpath(bytestring_path(prefix)), b"")
+                for prefix in config["devices"].as_str_seq()
+            ),
+            key=len,
+            reverse=True,
+        )
+        self._devices = {}
         self.check_integrity = config["integrity"].get(bool)
+        self.report = None
+        self.metrics = None
+        self.profile = None
+        self.profile_dump = None
+        self._profilers = threading.local()
 
         parser = OptionParser(usage="%prog [options] [QUERY...]")
         parser.add_option(
@@ -205,6 +689,13 @@ class CheckCommand(Subcommand):
             default=False,
             help="run external tools",
         )
+        parser.add_option(
+            "--all",
+            action="store_true",
+            dest="all",
+            default=False,
+            help="verify checksums and run integrity checks reading each file once",
+        )
         parser.add_option(
             "-a",
             "--add",
@@ -227,7 +718,105 @@ class CheckCommand(Subcommand):
             action="store_true",
             dest="force",
             default=False,
-            help="force updating the whole library or fixing all files",
+            help="force updating the whole library or fixing all files, "
+            "ignore cached integrity results and replace checksums with "
+            "imported ones",
+        )
+        parser.add_option(
+            "--quick",
+            action="store_true",
+            dest="quick",
+            default=False,
+            help="only read files whose size or modification time changed",
+        )
+        parser.add_option(
+            "--rehash-to",
+            dest="rehash_to",
+            metavar="ALGORITHM",
+            help="verify checksums and replace them with checksums computed "
+            "with ALGORITHM",
+        )
+        parser.add_option(
+            "--order",
+            choices=["db", "path", "inode", "extent", "verified"],
+            default="db",
+            help="process files in database order (default), by path, by inode, "
+            "by their physical location on disk (extent) or least recently "
+            "verified first",
+        )
+        parser.add_option(
+            "--budget-time",
+            metavar="DURATION",
+            help="verify the least recently verified files until DURATION "
+            "(e.g. 90m or 2h) has passed",
+        )
+        parser.add_option(
+            "--budget-bytes",
+            metavar="SIZE",
+            help="verify the least recently verified files until SIZE (e.g. "
+            "500G) has been read",
+        )
+        parser.add_option(
+            "--resume",
+            action="store_true",
+            dest="resume",
+            default=False,
+            help="record progress and continue an interrupted run",
+        )
+        parser.add_option(
+            "--format",
+            choices=["text", "jsonl", *EXPORT_FORMATS],
+            default="text",
+            dest="format",
+            help="print a JSON record for each file instead of the progress "
+            "(text or jsonl) or the format of --export "
+            f"({', '.join(EXPORT_FORMATS)} or jsonl)",
+        )
+        parser.add_option(
+            "--report",
+            dest="report",
+            metavar="FILE",
+            help="write a JSON record for each file to FILE",
+        )
+        parser.add_option(
+            "--metrics-file",
+            dest="metrics_file",
+            metavar="PATH",
+            help="write Prometheus metrics of the run to PATH",
+        )
+        parser.add_option(
+            "--profile",
+            action="store_true",
+            dest="profile",
+            default=False,
+            help="print the time spent in each phase of the run",
+        )
+        parser.add_option(
+            "--profile-dump",
+            dest="profile_dump",
+            metavar="FILE",
+            help="profile the workers with cProfile and write the stats to FILE",
+        )
+        parser.add_option(
+            "--import-manifest",
+            dest="import_manifest",
+            metavar="FILE",
+            help="add checksums from a sha256sum or BSD style manifest",
+        )
+        parser.add_option(
+            "--rewrite-prefix",
+            action="append",
+            dest="rewrite_prefix",
+            default=[],
+            metavar="OLD=NEW",
+            help="replace the path prefix OLD in the manifest with NEW",
+        )
+        parser.add_option(
+            "--stat",
+            action="store_true",
+            dest="stat",
+            default=False,
+            help="skip manifest entries whose file is missing or empty",
         )
         parser.add_option(
             "--export",
@@ -236,6 +825,12 @@ class CheckCommand(Subcommand):
             default=False,
             help="print paths and corresponding checksum",
         )
+        parser.add_option(
+            "--output",
+            dest="output",
+            metavar="FILE",
+            help="write the output of --export to FILE",
+        )
         parser.add_option(
             "-x",
             "--fix",
@@ -270,27 +865,115 @@ class CheckCommand(Subcommand):
         arguments = decargs(arguments)
         self.query = arguments
         self.force_update = options.force
+        self.quick = options.quick
+        self.order = options.order
+        self.budget_time = self.budget_bytes = None
+        if options.budget_time:
+            self.budget_time = parse_duration(options.budget_time)
+        if options.budget_bytes:
+            self.budget_bytes = parse_size(options.budget_bytes)
+        if self.budget_time is not None or self.budget_bytes is not None:
+            if self.order not in ("db", "verified"):
+                raise UserError("a budget can only be combined with --order=verified")
+            self.order = "verified"
+        self.resume = options.resume
+        self.checkpoint = None
+        if self.resume and any_mode(options) and not (options.add or options.all):
+            raise UserError(
+                "--resume can only be used to check files or to add checksums"
+            )
+        if options.export:
+            self.export_format = options.format
+            if self.export_format == "text":
+                self.export_format = "sha256sum"
+        elif options.format not in ("text", "jsonl"):
+            raise UserError(f"--format={options.format} requires --export")
+        elif options.output:
+            raise UserError("--output requires --export")
+        reporting = options.report or (options.format == "jsonl" and not options.export)
+        if (
+            (reporting or options.metrics_file)
+            and any_mode(options)
+            and not (options.add or options.update or options.fix or options.all)
+        ):
+            raise UserError(
+                "reports and metrics can only be written when checking files or "
+                "when adding, updating or fixing checksums"
+            )
+        self.report = None
+        self.metrics = None
+        if options.metrics_file:
+            self.metrics = Metrics(mode_name(options))
+        global active_profile
+        self.profile = None
+        if options.profile or options.profile_dump:
+            self.profile = active_profile = Profile()
+        self.profile_dump = options.profile_dump
+        self.profilers = []
+        self._profilers = threading.local()
+        with contextlib.ExitStack() as stack:
+            if self.profile:
+                stack.callback(self.print_profile)
+            if self.metrics:
+                stack.callback(self.metrics.write, options.metrics_file)
+            if options.report:
+                file = stack.enter_context(open(options.report, "w"))
+                self.report = Report(file)
+            elif options.format == "jsonl":
+                # Records go to stdout instead of progress and summaries
+                self.quiet = True
+                self.report = Report(sys.stdout)
+            self.writer = stack.enter_context(
+                ItemWriter(lib, self.commit_batch, self.commit_interval)
+            )
+            # Let a terminated run write its last checkpoint
+            if self.resume:
+                handler = signal.signal(signal.SIGTERM, terminate)
+            try:
+                self.run(options)
+            finally:
+                if self.resume:
+                    # `SIG_DFL` is falsy and `None` means the previous handler
+                    # was not installed from Python.
+                    signal.signal(signal.SIGTERM, handler or signal.SIG_DFL)
+                if self.checkpoint:
+                    self.checkpoint.flush()
+
+    def run(self, options):
         if options.add:
             self.add()
         elif options.update:
             self.update()
+        elif options.rehash_to:
+            self.rehash(options.rehash_to)
         elif options.export:
-            self.export()
+            self.export(self.export_format, options.output)
+        elif options.import_manifest:
+            self.import_manifest(
+                options.import_manifest,
+                [parse_rewrite(rewrite) for rewrite in options.rewrite_prefix],
+                options.stat,
+            )
         elif options.fix:
             self.fix(ask=not options.force)
         elif options.list_tools:
             self.list_tools()
+        elif options.all:
+            if self.quick:
+                raise UserError("--all cannot be combined with --quick")
+            self.check(external=False, all=True)
         else:
             self.check(options.external)
 
     def add(self):
         self.log("Looking for files without checksums...")
-        items = [i for i in self.lib.items(self.query) if not i.get("checksum", None)]
+        items, total = self.items(lambda i: not i.get("checksum", None))
+        items, total, _ = self.resumable("add", items, total)
 
         def add(item):
             log.debug(f"adding checksum for {displayable_path(item.path)}")
             try:
-                set_checksum(item)
+                assign_checksum(item)
             except FileNotFoundError:
                 log.warning(
                     "{} {}: {}".format(
@@ -299,11 +982,16 @@ class CheckCommand(Subcommand):
                         displayable_path(item.path),
                     )
                 )
+                self.result("error", "No such file")
+                self.finished(item)
                 return
+            self.writer.store(item)
+            self.result("added")
             if self.check_integrity:
                 try:
                     verify_integrity(item)
                 except IntegrityError as ex:
+                    self.result("warning", ex)
                     log.warning(
                         "{} {}: {}".format(
                             colorize("text_warning", "WARNING"),
@@ -311,63 +999,145 @@ class CheckCommand(Subcommand):
                             displayable_path(item.path),
                         )
                     )
+            self.finished(item)
 
-        self.execute_with_progress(add, items, msg="Adding missing checksums")
+        self.execute_with_progress(
+            add, items, msg="Adding missing checksums", total=total
+        )
+        self.complete()
 
-    def check(self, external):
+    def check(self, external, all=False):
+        """Verify checksums, run the integrity checkers (`external`), or do
+        both while reading each file once (`all`).
+        """
         if external and not IntegrityChecker.allAvailable():
             no_checkers_warning = (
                 "No integrity checkers found. Run 'beet check --list-tools'"
             )
             raise UserError(no_checkers_warning)
 
-        if external:
-            progs = [c.name for c in IntegrityChecker.allAvailable()]
+        if (external or all) and IntegrityChecker.checking():
+            progs = [c.name for c in IntegrityChecker.checking()]
             plural = "s" if len(progs) > 1 else ""
             self.log("Using integrity checker{} {}".format(plural, ", ".join(progs)))
 
-        items = list(self.lib.items(self.query))
-        failures = [0]
-
-        def check(item):
-            try:
-                if external:
-                    verify_integrity(item)
-                elif item.get("checksum", None):
-                    verify_checksum(item)
+        items, total = self.items()
+        command = "all" if all else "external" if external else "check"
+        items, total, resumed_failures = self.resumable(command, items, total)
+        budgeted = self.budget_time is not None or self.budget_bytes is not None
+        if budgeted:
+            items = self.within_budget(items)
+        failures = [resumed_failures]
+
+        def report(item, error=None):
+            """Log the result for the item and return the number of
+            failures.
+            """
+            if error is None:
                 log.debug(
                     "{}: {}".format(
                         colorize("text_success", "OK"), displayable_path(item.path)
                     )
                 )
-            except ChecksumError:
+                self.result("ok")
+                return 0
+            if isinstance(error, ChecksumError):
+                self.result("failed", error)
+            elif isinstance(error, IntegrityError):
+                self.result("warning", error)
+            else:
+                self.result("error", error)
+            failures[0] += 1
+            if isinstance(error, ChecksumError):
                 log.error(
                     "{}: {}".format(
                         colorize("text_error", "FAILED"), displayable_path(item.path)
                     )
                 )
-                failures[0] += 1
-            except IntegrityError as ex:
+            elif isinstance(error, IntegrityError):
                 log.warning(
                     "{} {}: {}".format(
                         colorize("text_warning", "WARNING"),
-                        ex.reason,
+                        error.reason,
                         displayable_path(item.path),
                     )
                 )
-                failures[0] += 1
+            else:
+                log.error("{} {}".format(colorize("text_error", "ERROR"), error))
+            return 1
+
+        def check(item):
+            try:
+                if item.get("checksum", None):
+                    if self.quick:
+                        if verify_checksum_quick(item):
+                            self.writer.store(item)
+                    else:
+                        verify_checksum(item)
+                        mark_verified(item)
+                        self.writer.store(item)
+            except (ChecksumError, OSError) as exc:
+                self.finished(item, report(item, exc))
+            else:
+                self.finished(item, report(item))
+
+        async def check_external(item):
+            verdicts = item.get("integrity_verdicts", None)
+            try:
+                await verify_integrity_async(
+                    item, self.processes, cache=not self.force_update
+                )
+            except (IntegrityError, OSError) as exc:
+                failed = report(item, exc)
+            else:
+                failed = report(item)
+            if item.get("integrity_verdicts", None) != verdicts:
+                await self.writer.store_async(item)
+            if self.checkpoint:
+                # Writing a checkpoint waits for room in the writer's queue
+                await asyncio.to_thread(self.finished, item, failed)
+
+        def check_all(item):
+            try:
+                errors = verify_all(item)
             except OSError as exc:
-                log.error("{} {}".format(colorize("text_error", "ERROR"), exc))
-                failures[0] += 1
+                errors = [exc]
+            else:
+                if item.get("checksum", None) and not any(
+                    isinstance(error, ChecksumError) for error in errors
+                ):
+                    mark_verified(item)
+                    self.writer.store(item)
+            failed = sum(report(item, error) for error in errors)
+            if not errors:
+                report(item)
+            self.finished(item, failed)
 
         if external:
-            msg = "Running external tests"
+            self.execute_async(
+                check_external, items, "Running external tests", total=total
+            )
+        elif all:
+            self.execute_with_progress(
+                check_all, items, "Verifying checksums and integrity", total=total
+            )
         else:
-            msg = "Verifying checksums"
-        self.execute_with_progress(check, items, msg)
+            self.execute_with_progress(check, items, "Verifying checksums", total=total)
+
+        self.complete()
+        if budgeted:
+            self.log(
+                f"Checked {self.budget_count} of {total} file(s) within the budget"
+            )
 
         failures = failures[0]
-        if external:
+        if all:
+            if failures:
+                self.log(f"Found {failures} error(s)")
+                sys.exit(15)
+            else:
+                self.log("All checksums and integrity successfully verified")
+        elif external:
             if failures:
                 self.log(f"Found {failures} integrity error(s)")
                 sys.exit(15)
@@ -391,51 +1161,306 @@ class CheckCommand(Subcommand):
         ):
             return
 
-        items = self.lib.items(self.query)
+        items, total = self.items()
 
         def update(item):
-            log.debug(f"updating checksum: {displayable_path(item.path)}")
             try:
-                set_checksum(item)
+                if self.quick and stat_matches(item, os.stat(syspath(item.path))):
+                    self.result("unchanged")
+                    return
+                log.debug(f"updating checksum: {displayable_path(item.path)}")
+                assign_checksum(item)
+                self.writer.store(item)
+                self.result("updated")
             except OSError as exc:
+                self.result("error", exc)
                 log.error("{} {}".format(colorize("text_error", "ERROR"), exc))
 
-        self.execute_with_progress(update, items, msg="Updating checksums")
+        self.execute_with_progress(update, items, msg="Updating checksums", total=total)
+
+    def rehash(self, algorithm):
+        if algorithm not in ALGORITHMS:
+            raise UserError(f"unsupported checksum algorithm {algorithm}")
 
-    def export(self):
-        for item in self.lib.items(self.query):
-            if item.get("checksum", None):
-                print(f"{item.checksum} *{displayable_path(item.path)}")  # noqa: T201
+        items, total = self.items(
+            lambda i: (
+                i.get("checksum", None)
+                and parse_checksum(i["checksum"])[0] != algorithm
+            )
+        )
+        failures = [0]
+
+        def rehash(item):
+            old_algorithm, old_digest = parse_checksum(item["checksum"])
+            try:
+                if old_algorithm not in ALGORITHMS:
+                    raise ChecksumError(
+                        item.path, f"unsupported checksum algorithm {old_algorithm}"
+                    )
+                stat = os.stat(syspath(item.path))
+                digest, new_digest = hash_file(
+                    syspath(item.path), [old_algorithm, algorithm]
+                )
+                if digest != old_digest:
+                    raise ChecksumError(
+                        item.path, "checksum did not match value in library."
+                    )
+            except ChecksumError:
+                log.error(
+                    "{}: {}".format(
+                        colorize("text_error", "FAILED"), displayable_path(item.path)
+                    )
+                )
+                failures[0] += 1
+                return
+            except OSError as exc:
+                log.error("{} {}".format(colorize("text_error", "ERROR"), exc))
+                failures[0] += 1
+                return
+            log.debug(f"rehashing checksum: {displayable_path(item.path)}")
+            item["checksum"] = format_checksum(algorithm, new_digest)
+            record_stat(item, stat)
+            mark_verified(item)
+            self.writer.store(item)
+
+        self.execute_with_progress(
+            rehash, items, msg=f"Rehashing to {algorithm}", total=total
+        )
+
+        failures = failures[0]
+        if failures:
+            self.log(f"Failed to verify checksum of {failures} file(s)")
+            sys.exit(15)
+
+    def export(self, format="sha256sum", output=None):
+        """Write the checksums of the items matching the query in the given
+        format to `output` or `stdout`.
+        """
+        with contextlib.ExitStack() as stack:
+            if output:
+                file = stack.enter_context(
+                    open(
+                        output,
+                        "w",
+                        encoding="utf-8",
+                        errors="surrogateescape",
+                        newline="",
+                        buffering=EXPORT_BUFFER,
+                    )
+                )
+            else:
+                file = sys.stdout
+                # Write paths that are not valid UTF-8 as they are
+                if hasattr(file, "reconfigure"):
+                    stack.callback(file.reconfigure, errors=file.errors)
+                    file.reconfigure(errors="surrogateescape")
+            write_export(file, format, self.checksums())
+
+    def checksums(self):
+        """Yield the ID, the path and the checksum of the items matching the
+        query in the order of their IDs.
+
+        Only these columns are selected from the database and no `Item` is
+        created. Queries that cannot be expressed in SQL, like queries of
+        album fields, fall back to loading the items.
+        """
+        clause = self.query_clause()
+        if clause is None:
+            for item in self.lib.items(self.query):
+                if item.get("checksum", None):
+                    yield item.id, item.path, item["checksum"]
+            return
+
+        rows = self.select(
+            "items.id, items.path, item_attributes.value",
+            clause,
+            "JOIN item_attributes ON item_attributes.entity_id = items.id "
+            "AND item_attributes.key = 'checksum' "
+            "WHERE item_attributes.value != '' "
+            "ORDER BY items.id",
+        )
+        for id, path, checksum in rows:
+            yield id, path_from_sql(path), checksum
+
+    def import_manifest(self, path, rewrites=(), stat=False):
+        """Add the checksums listed in the manifest to the items matching
+        the query without reading the files.
+
+        Entries are matched to items by their path after applying the first
+        matching prefix rewrite. Items that already have a checksum are
+        skipped unless `--force` is given. If `stat` is true entries whose
+        file is missing or empty are skipped, too. Checksums are written in
+        transactions of `commit_batch` items.
+        """
+        items = self.items_by_path()
+        counts = Counter()
+        batch = []
+
+        def store():
+            with self.lib.transaction() as tx:
+                for id, checksum in batch:
+                    tx.mutate(
+                        "INSERT INTO item_attributes (entity_id, key, value) "
+                        "VALUES (?, 'checksum', ?)",
+                        (id, checksum),
+                    )
+                    # The metadata of the file and the time of the last
+                    # verification belong to the replaced checksum.
+                    tx.mutate(
+                        "DELETE FROM item_attributes WHERE entity_id = ? AND key IN "
+                        "('checksum_mtime', 'checksum_size', 'checksum_inode', "
+                        "'checksum_verified_at')",
+                        (id,),
+                    )
+            batch.clear()
+
+        with contextlib.ExitStack() as stack:
+            if path == "-":
+                file = sys.stdin.buffer
+                directory = os.getcwd()
+            else:
+                file = stack.enter_context(open(syspath(path), "rb"))
+                directory = os.path.dirname(os.path.abspath(syspath(path)))
+            for entry in parse_manifest(file):
+                if entry is None:
+                    counts["invalid"] += 1
+                    continue
+                file_path, checksum = entry
+                for old, new in rewrites:
+                    if file_path.startswith(old):
+                        file_path = new + file_path[len(old) :]
+                        break
+                file_path = normpath(os.path.join(os.fsencode(directory), file_path))
+                if file_path not in items:
+                    log.debug(f"not in library: {displayable_path(file_path)}")
+                    counts["unmatched"] += 1
+                    continue
+                id, has_checksum = items[file_path]
+                if has_checksum and not self.force_update:
+                    counts["skipped"] += 1
+                    continue
+                if stat:
+                    try:
+                        size = os.stat(syspath(file_path)).st_size
+                    except OSError:
+                        size = 0
+                    if not size:
+                        log.warning(
+                            "{} {}: {}".format(
+                                colorize("text_warning", "WARNING"),
+                                "No such file or empty file",
+                                displayable_path(file_path),
+                            )
+                        )
+                        counts["missing"] += 1
+                        continue
+                batch.append((id, checksum))
+                counts["imported"] += 1
+                if len(batch) >= self.commit_batch:
+                    store()
+        if batch:
+            store()
+
+        self.log(f"Imported {counts['imported']} checksum(s)")
+        for key, msg in (
+            ("skipped", "item(s) already had a checksum"),
+            ("unmatched", "file(s) not in the library"),
+            ("missing", "file(s) missing or empty"),
+            ("invalid", "invalid line(s)"),
+        ):
+            if counts[key]:
+                self.log(f"Skipped {counts[key]} {msg}")
+
+    def items_by_path(self):
+        """Return a dictionary that maps the path of each item matching the
+        query to its ID and whether it has a checksum.
+
+        Only these columns are selected from the database unless the query
+        cannot be expressed in SQL.
+        """
+        clause = self.query_clause()
+        if clause is None:
+            return {
+                item.path: (item.id, bool(item.get("checksum", None)))
+                for item in self.lib.items(self.query)
+            }
+        rows = self.select(
+            "items.id, items.path, EXISTS(SELECT 1 FROM item_attributes "
+            "WHERE entity_id = items.id AND key = 'checksum' AND value != '')",
+            clause,
+        )
+        return {
+            path_from_sql(path): (id, bool(has_checksum))
+            for id, path, has_checksum in rows
+        }
+
+    def query_clause(self):
+        """Return the SQL condition of the query and its values.
+
+        Returns `None` if the query cannot be expressed in SQL, like queries
+        of album fields.
+        """
+        query, _ = parse_query_parts(self.query, Item)
+        where, subvals = query.clause()
+        other_fields = getattr(Item, "other_db_fields", set())
+        if where is None or getattr(query, "field_names", set()) & other_fields:
+            return None
+        return where, subvals
+
+    def select(self, columns, clause, rest=""):
+        """Yield the rows of `columns` of the items matching `clause`.
+
+        `clause` is returned by `query_clause`. The items table is filtered
+        in a subquery that only has the `id` and `path` columns, so that the
+        query's columns are not ambiguous with joined tables. The database
+        is locked until the rows have been consumed. Values are not converted
+        by the types of the fields, see `path_from_sql()`.
+        """
+        where, subvals = clause
+        sql = (
+            f"SELECT {columns} "
+            f"FROM (SELECT id, path FROM items WHERE {where}) AS items {rest}"
+        )
+        with self.lib.transaction() as tx:
+            # Iterate the cursor instead of using `tx.query()`, which
+            # fetches all rows at once.
+            yield from tx.db._connection().execute(sql, subvals)
 
     def fix(self, ask=True):
-        items = list(self.lib.items(self.query))
+        items, total = self.items()
         failed = []
 
         def check(item):
+            fixer = IntegrityChecker.fixer(item)
             try:
-                if "checksum" in item:
-                    verify_checksum(item)
-                fixer = IntegrityChecker.fixer(item)
-                if fixer:
-                    fixer.check(item)
-                    log.debug(
-                        "{}: {}".format(
-                            colorize("text_success", "OK"), displayable_path(item.path)
-                        )
-                    )
-            except IntegrityError:
-                failed.append(item)
-            except ChecksumError:
+                # Verify the checksum and run the fixer on a single read
+                errors = verify_all(item, [fixer] if fixer else [])
+            except OSError as exc:
+                self.result("error", exc)
+                log.error("{} {}".format(colorize("text_error", "ERROR"), exc))
+                return
+            for error in errors:
+                if isinstance(error, ChecksumError):
+                    self.result("failed", error)
+                else:
+                    self.result("warning", error)
+            if any(isinstance(error, ChecksumError) for error in errors):
                 log.error(
                     "{}: {}".format(
                         colorize("text_error", "FAILED checksum"),
                         displayable_path(item.path),
                     )
                 )
-            except OSError as exc:
-                log.error("{} {}".format(colorize("text_error", "ERROR"), exc))
+            elif errors:
+                failed.append(item)
+            elif fixer:
+                log.debug(
+                    "{}: {}".format(
+                        colorize("text_success", "OK"), displayable_path(item.path)
+                    )
+                )
 
-        self.execute_with_progress(check, items, msg="Verifying integrity")
+        self.execute_with_progress(check, items, msg="Verifying integrity", total=total)
 
         if not failed:
             self.log("No MP3 files to fix")
@@ -452,15 +1477,18 @@ class CheckCommand(Subcommand):
         def fix(item):
             fixer = IntegrityChecker.fixer(item)
             if fixer:
-                fixer.fix(item)
+                with phase("fix"):
+                    fixer.fix(item)
+                self.result("fixed")
                 log.debug(
                     "{}: {}".format(
                         colorize("text_success", "FIXED"), displayable_path(item.path)
                     )
                 )
-                set_checksum(item)
+                assign_checksum(item)
+                self.writer.store(item)
 
-        self.execute_with_progress(fix, failed, msg="Fixing files")
+        self.execute_with_progress(fix, failed, msg="Fixing files", total=len(failed))
 
     def list_tools(self):
         checkers = [
@@ -475,35 +1503,1058 @@ class CheckCommand(Subcommand):
                 msg += colorize("text_error", "not found")
             print(msg)  # noqa: T201
 
+    def items(self, predicate=None):
+        """Return the items matching the query in the order given by the
+        `--order` option and the number of items, if it is known.
+
+        If `predicate` is given only items for which it returns a true value
+        are included.
+
+        Only the IDs of the matching items are selected up front and the
+        items are loaded in batches as they are consumed, so the memory
+        usage grows by the size of an ID per item. Ordering by inode or
+        extent looks up every file first. Queries that cannot be expressed
+        in SQL load all items.
+        """
+        clause = self.query_clause()
+        if clause is None:
+            return self.loaded_items(predicate)
+
+        if self.order in ("inode", "extent"):
+            layout_key = extent_key if self.order == "extent" else inode_key
+            keys = sorted(
+                (layout_key(syspath(path_from_sql(path))), id)
+                for id, path in self.select("items.id, items.path", clause)
+            )
+            ids = array("q", (id for _, id in keys))
+        else:
+            rest = (
+                "ORDER BY items.path" if self.order == "path" else "ORDER BY items.id"
+            )
+            if self.order == "verified":
+                # Like `verified_at`, items that were never verified count as
+                # verified at time 0.
+                rest = (
+                    "LEFT JOIN item_attributes AS verified "
+                    "ON verified.entity_id = items.id "
+                    "AND verified.key = 'checksum_verified_at' "
+                    "ORDER BY COALESCE(CAST(verified.value AS REAL), 0), items.id"
+                )
+            rows = self.select("items.id", clause, rest)
+            ids = array("q", (id for (id,) in rows))
+
+        items = self.items_by_id(ids)
+        if predicate:
+            return (i for i in items if predicate(i)), None
+        return items, len(ids)
+
+    def loaded_items(self, predicate=None):
+        """Like `items` but loads all items matching the query at once."""
+        if self.order == "path":
+            sort = FixedFieldSort("path", case_insensitive=False)
+            results = self.lib.items(self.query, sort)
+        else:
+            results = self.lib.items(self.query)
+        items = [item for item in results if predicate is None or predicate(item)]
+        if self.order == "verified":
+            items.sort(key=lambda item: (verified_at(item), item.id))
+        elif self.order in ("inode", "extent"):
+            layout_key = extent_key if self.order == "extent" else inode_key
+            items.sort(key=lambda item: layout_key(syspath(item.path)))
+        return iter(items), len(items)
+
+    def resumable(self, command, items, total):
+        """Checkpoint the finished items if `--resume` is given.
+
+        Items that were finished by an interrupted run of the same command
+        with the same arguments are skipped. Returns the remaining items,
+        their number, if known, and the number of failures found by the
+        interrupted run.
+        """
+        if not self.resume:
+            return items, total, 0
+        run = {
+            "command": command,
+            "library": displayable_path(self.lib.path),
+            "query": self.query,
+            "order": self.order,
+            "quick": self.quick,
+        }
+        path = os.path.join(beets.config.config_dir(), "check.resume")
+        self.checkpoint = Checkpoint(path, run, self.writer, self.commit_batch)
+        done = self.checkpoint.done
+        if not done:
+            return items, total, 0
+        self.log(f"Resuming: skipping {len(done)} file(s) checked before")
+        if total is not None:
+            total = max(total - len(done), 0)
+        items = (item for item in items if item.id not in done)
+        return items, total, self.checkpoint.failures
+
+    def finished(self, item, failures=0):
+        """Record that the item has been processed for `--resume`."""
+        if self.checkpoint:
+            self.checkpoint.finished(item.id, failures)
+
+    def complete(self):
+        """Forget the checkpoints after the run has finished."""
+        if self.checkpoint:
+            self.checkpoint.complete()
+            self.checkpoint = None
+
+    def within_budget(self, items):
+        """Yield items until the time budget has passed or the size of the
+        yielded files reaches the byte budget.
+
+        Items that are being processed when the budget runs out are finished.
+        """
+        start = time.monotonic()
+        size = 0
+        self.budget_count = 0
+        for item in items:
+            if self.budget_time is not None and (
+                time.monotonic() - start >= self.budget_time
+            ):
+                return
+            if self.budget_bytes is not None:
+                if size >= self.budget_bytes:
+                    return
+                with contextlib.suppress(OSError):
+                    size += os.stat(syspath(item.path)).st_size
+            self.budget_count += 1
+            yield item
+
+    def items_by_id(self, ids, batch_size=500):
+        """Yield the items with the given IDs in the same order."""
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start : start + batch_size]
+            query = OrQuery([MatchQuery("id", id) for id in batch])
+            items = {item.id: item for item in self.lib.items(query)}
+            yield from (items[id] for id in batch if id in items)
+
     def log(self, msg):
         if not self.quiet:
             print(msg)  # noqa: T201
 
-    def log_progress(self, msg, index, total):
-        if self.quiet or not sys.stdout.isatty():
+    def result(self, status, error=None):
+        """Record the status of the item that is being processed for the
+        report.
+
+        `error` is an exception or a message. The first error of an item
+        determines its status.
+        """
+        result = current_result.get()
+        if result is None or result["reason"] is not None:
             return
-        msg = f"{msg}: {index}/{total} [{index * 100 / total}%]"
-        sys.stdout.write(msg + "\r")
-        sys.stdout.flush()
-        if index == total:
-            sys.stdout.write("\n")
-        else:
-            sys.stdout.write(len(msg) * " " + "\r")
+        result["status"] = status
+        if error is not None:
+            result["reason"] = getattr(error, "reason", None) or str(error)
+            result["checker"] = getattr(error, "checker", None)
+
+    def tracking(self):
+        """Return whether the results of items are recorded."""
+        return (
+            self.report is not None
+            or self.metrics is not None
+            or self.profile is not None
+        )
 
-    def execute_with_progress(self, func, args, msg=None):
-        """Run `func` for each value in the iterator `args` in a thread pool.
+    def write_result(self, item):
+        """Write the result of the item to the report, the metrics and the
+        profile.
+        """
+        result = current_result.get()
+        if self.metrics:
+            self.metrics.record(result)
+        if self.profile:
+            for name, duration in result["durations"].items():
+                self.profile.add(name, duration)
+        if not self.report:
+            return
+        self.report.write({
+            "id": item.id,
+            "path": displayable_path(item.path),
+            "status": result["status"] or "ok",
+            "reason": result["reason"],
+            "checker": result["checker"],
+            "bytes": result["bytes"],
+            "durations": {
+                name: round(duration, 6)
+                for name, duration in result["durations"].items()
+            },
+        })
 
-        When the function has finished it logs the progress and the `msg`.
+    def print_profile(self):
+        """Print the profile to stderr and write the cProfile stats."""
+        global active_profile
+        active_profile = None
+        for line in self.profile.lines():
+            print(line, file=sys.stderr)  # noqa: T201
+        if self.profile_dump and self.profilers:
+            stats = pstats.Stats(*self.profilers)
+            stats.dump_stats(self.profile_dump)
+            log.info(f"Wrote profile to {displayable_path(self.profile_dump)}")
+
+    def profiler(self):
+        """Return the cProfile profiler of the current worker thread."""
+        local = self._profilers
+        if not hasattr(local, "profiler"):
+            local.profiler = cProfile.Profile()
+            self.profilers.append(local.profiler)
+        return local.profiler
+
+    def call_profiled(self, func, arg):
+        """Call `func` with the cProfile profiler of the current thread.
+
+        Since Python 3.12 only one thread can be profiled at a time. Calls
+        that start while another thread is profiled are not profiled.
         """
-        total = len(args)
-        finished = 0
+        profiler = self.profiler()
+        try:
+            profiler.enable()
+        except ValueError:
+            return func(arg)
+        try:
+            return func(arg)
+        finally:
+            profiler.disable()
+
+    def progress(self, msg, total):
+        """Return a `Progress` that draws to `stdout` unless `--quiet` is
+        given or `stdout` is not a terminal.
+        """
+        enabled = not self.quiet and sys.stdout.isatty()
+        return Progress(msg, total, sys.stdout if enabled else None)
+
+    def execute_with_progress(self, func, args, msg=None, total=None):
+        """Run `func` for each value in the iterable `args` in a thread pool.
+
+        Values are taken from `args` only when a worker is about to become
+        free, so that at most a few values per thread are pending at any
+        time. When the function has finished it logs the progress and the
+        `msg`. `total` is the number of values, if known.
+
+        If `per_device_threads` is configured the values must be items. The
+        items are grouped by the device their file is stored on and at most
+        `per_device_threads` items of each device are processed at the same
+        time.
+        """
+        if self.per_device_threads:
+            limit = self.per_device_threads
+            # Look ahead far enough to find work for idle devices
+            lookahead = 64 * self.threads
+            device = self.device
+        else:
+            limit = lookahead = 4 * self.threads
+            device = lambda arg: None  # noqa: E731
+
+        progress = self.progress(msg, total)
+
+        def run(arg):
+            progress.start(arg)
+            token = current_result.set(new_result()) if self.tracking() else None
+            try:
+                if self.profile_dump:
+                    self.call_profiled(func, arg)
+                else:
+                    func(arg)
+            except Exception as exc:
+                self.result("error", exc)
+                raise
+            finally:
+                if token:
+                    self.write_result(arg)
+                    current_result.reset(token)
+                progress.finish(arg)
+
+        args = profiled_iter(args, "query") if self.profile else iter(args)
+        backlog = defaultdict(deque)
+        running = Counter()
+        pending = {}
+        buffered = 0
         with futures.ThreadPoolExecutor(max_workers=self.threads) as e:
-            for _ in e.map(func, args):
-                finished += 1
-                self.log_progress(msg, finished, total)
+            while True:
+                for arg in itertools.islice(args, lookahead - buffered):
+                    backlog[device(arg)].append(arg)
+                    buffered += 1
+                for key, waiting in backlog.items():
+                    while waiting and running[key] < limit:
+                        pending[e.submit(run, waiting.popleft())] = key
+                        running[key] += 1
+                if not pending:
+                    break
+                done, _ = futures.wait(
+                    pending,
+                    timeout=progress.interval,
+                    return_when=futures.FIRST_COMPLETED,
+                )
+                for future in done:
+                    running[pending.pop(future)] -= 1
+                    buffered -= 1
+                    future.result()
+                progress.draw()
+        progress.close()
+
+    def execute_async(self, func, args, msg=None, total=None):
+        """Run the coroutine function `func` for each value in the iterable
+        `args` on an event loop.
+
+        This is used for external tools, which don't need a thread each while
+        we wait for them. `func` should acquire `self.processes` to limit the
+        number of tools running at the same time to `external_concurrency`.
+        Enough calls are started to fill the batches of checkers that check
+        multiple files with one invocation.
+        """
+        asyncio.run(self._execute_async(func, args, msg, total))
+
+    async def _execute_async(self, func, args, msg, total):
+        self.processes = asyncio.Semaphore(self.external_concurrency)
+        batch = max(
+            (getattr(c, "batch", 0) for c in IntegrityChecker.checking()),
+            default=0,
+        )
+        window = self.external_concurrency * max(batch, 1)
+        progress = self.progress(msg, total)
+        pending = set()
+
+        async def run(arg):
+            progress.start(arg)
+            # Tasks have their own context
+            if self.tracking():
+                current_result.set(new_result())
+            try:
+                await func(arg)
+            except Exception as exc:
+                self.result("error", exc)
+                raise
+            finally:
+                if self.tracking():
+                    self.write_result(arg)
+                progress.finish(arg)
+
+        async def wait_first():
+            nonlocal pending
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, timeout=0.1, return_when=asyncio.FIRST_COMPLETED
+                )
+                progress.draw()
+                if done:
+                    break
+                # Batches that are not full are only run once all calls wait
+                # for them. Until then running calls may still fill them.
+                if integrity_batch_waiters() >= len(pending):
+                    flush_integrity_batches()
+            for task in done:
+                task.result()
+
+        if self.profile:
+            args = profiled_iter(args, "query")
+        for arg in args:
+            if len(pending) >= window:
+                await wait_first()
+            pending.add(asyncio.create_task(run(arg)))
+        while pending:
+            await wait_first()
+        progress.close()
+
+    def device(self, item):
+        """Return a key identifying the device that stores the item's file.
+
+        This is the longest matching prefix from the `devices` option or the
+        device ID of the file's directory.
+        """
+        for prefix in self.device_prefixes:
+            if item.path.startswith(prefix):
+                return prefix
+        directory = os.path.dirname(item.path)
+        if directory not in self._devices:
+            try:
+                self._devices[directory] = os.stat(syspath(directory)).st_dev
+            except OSError:
+                self._devices[directory] = None
+        return self._devices[directory]
+
+
+# Formats of `--export`
+EXPORT_FORMATS = ["sha256sum", "bsd", "csv"]
+
+EXPORT_BUFFER = 1024 * 1024
+
+
+def write_export(file, format, rows):
+    """Write the `(id, path, checksum)` rows to the file in the export
+    format. Lines are written in large chunks.
+    """
+    if format == "csv":
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(["id", "path", "algorithm", "checksum"])
+        writer.writerows(
+            (id, displayable_path(path), *parse_checksum(checksum))
+            for id, path, checksum in rows
+        )
+        return
+
+    def bsd_line(id, path, algorithm, digest):
+        name = BSD_NAMES.get(algorithm, algorithm.upper())
+        escaped, path = escape_manifest_path(path)
+        return f"{escaped}{name} ({path}) = {digest}\n"
+
+    if format == "bsd":
+        line = bsd_line
+
+    elif format == "jsonl":
+
+        def line(id, path, algorithm, digest):
+            record = {"id": id, "path": path, "algorithm": algorithm}
+            record["checksum"] = digest
+            return json.dumps(record) + "\n"
+
+    else:
+
+        def line(id, path, algorithm, digest):
+            # The length of the digest does not tell the algorithm apart
+            if algorithm != DEFAULT_ALGORITHM:
+                return bsd_line(id, path, algorithm, digest)
+            escaped, path = escape_manifest_path(path)
+            return f"{escaped}{digest} *{path}\n"
+
+    lines = (
+        line(id, displayable_path(path), *parse_checksum(checksum))
+        for id, path, checksum in rows
+    )
+    while chunk := "".join(itertools.islice(lines, 10000)):
+        file.write(chunk)
+
+
+def parse_manifest(file):
+    """Yield the path and the checksum of each line of a manifest from a
+    binary file.
+
+    Logs a warning and yields `None` for invalid lines and lines with
+    unsupported algorithms.
+    """
+    for entry in parse_manifest_entries(file):
+        if isinstance(entry, ManifestError):
+            log.warning(str(entry))
+            yield None
+        else:
+            yield entry
+
+
+def parse_rewrite(value):
+    """Parse `OLD=NEW` for `--rewrite-prefix` into two byte strings."""
+    old, sep, new = value.partition("=")
+    if not sep or not old:
+        raise UserError(f"invalid prefix rewrite {value}, expected OLD=NEW")
+    return os.fsencode(old), os.fsencode(new)
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_duration(value):
+    """Parse a duration like `90s`, `30m`, `2h` or `1d` into seconds.
+
+    A number without unit is a number of seconds.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*", value.lower())
+    if not match:
+        raise UserError(f"invalid duration {value}")
+    return float(match.group(1)) * DURATION_UNITS.get(match.group(2) or "s")
+
+
+def parse_size(value):
+    """Parse a size like `500G`, `10MiB` or `1024` into bytes.
+
+    Units are powers of 1024.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*", value.lower())
+    if not match:
+        raise UserError(f"invalid size {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(size):
+    """Format a number of bytes with a unit that is a power of 1024."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def format_duration(seconds):
+    """Format a duration like `1h02m`, `5m07s` or `12s`."""
+    seconds = int(seconds)
+    if seconds >= 60 * 60:
+        return f"{seconds // 3600}h{seconds // 60 % 60:02}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02}s"
+    return f"{seconds}s"
+
+
+def any_mode(options):
+    """Return whether a command other than checking checksums or running
+    integrity checks is given.
+    """
+    return any((
+        options.add,
+        options.update,
+        options.rehash_to,
+        options.export,
+        options.import_manifest,
+        options.fix,
+        options.list_tools,
+        options.all,
+    ))
+
+
+def mode_name(options):
+    """Return the name of the command given by the options for metrics."""
+    for name in ("add", "update", "fix", "all", "external"):
+        if getattr(options, name):
+            return name
+    return "check"
+
+
+def terminate(signum, frame):
+    sys.exit(128 + signum)
+
+
+def inode_key(path):
+    """Sort key that orders files by device and inode number.
+
+    On most file systems this approximates the order of the files on disk.
+    Missing files are sorted first.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (-1, 0, 0)
+    return (stat.st_dev, 0, stat.st_ino)
+
+
+def extent_key(path):
+    """Sort key that orders files by device and the physical offset of their
+    first extent.
+
+    Falls back to the inode number for files whose extents are unknown.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (-1, 0, 0)
+    offset = physical_offset(path)
+    if offset is None:
+        return (stat.st_dev, 1, stat.st_ino)
+    return (stat.st_dev, 0, offset)
+
+
+# See linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+_fiemap = struct.Struct("=QQIIII")
+_fiemap_extent = struct.Struct("=QQQQQIIII")
+
+
+def physical_offset(path):
+    """Return the physical offset of the file's first extent using the
+    FIEMAP ioctl.
+
+    Returns `None` if the platform or the file system doesn't support FIEMAP
+    or the file is empty.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return None
+    request = bytearray(_fiemap.size + _fiemap_extent.size)
+    # Map the whole file and return at most one extent
+    _fiemap.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    try:
+        with open(path, "rb") as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    mapped_extents = _fiemap.unpack_from(request)[3]
+    if not mapped_extents:
+        return None
+    return _fiemap_extent.unpack_from(request, _fiemap.size)[1]
+
+
+class Profile:
+    """Collects the durations of the phases of a run for `--profile`.
+
+    Phases of items are added once per item, other phases like `query`,
+    `store` or `spawn` once per call.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(lambda: array("d"))
+        self._lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self._lock:
+            self.samples[name].append(duration)
+
+    def lines(self):
+        """Yield a table with the total, median, 99th percentile and count of
+        each phase, longest total first.
+        """
+        rows = []
+        with self._lock:
+            for name, samples in self.samples.items():
+                ordered = sorted(samples)
+                rows.append((
+                    name,
+                    sum(ordered),
+                    percentile(ordered, 50),
+                    percentile(ordered, 99),
+                    len(ordered),
+                ))
+        rows.sort(key=operator.itemgetter(1), reverse=True)
+        width = max((len(row[0]) for row in rows), default=5)
+        yield (
+            f"{'phase':<{width}}  {'total':>10}  {'p50':>10}  {'p99':>10}  {'count':>8}"
+        )
+        for name, total, p50, p99, count in rows:
+            yield (
+                f"{name:<{width}}  {total:>9.3f}s  {p50 * 1000:>8.3f}ms  "
+                f"{p99 * 1000:>8.3f}ms  {count:>8}"
+            )
+
+
+def percentile(ordered, percent):
+    """Return the percentile of the sorted list by the nearest rank."""
+    if not ordered:
+        return 0
+    rank = max(int(len(ordered) * percent / 100 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Histogram:
+    """Counts observations in cumulative buckets like a Prometheus
+    histogram.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """Yield the lines of the histogram in the text format."""
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            yield f"{name}_bucket{format_labels({**labels, 'le': bound})} {cumulative}"
+        yield f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {self.count}"
+        yield f"{name}_sum{format_labels(labels)} {self.sum}"
+        yield f"{name}_count{format_labels(labels)} {self.count}"
+
+
+# Phases of reading and hashing a file
+READ_PHASES = ("open", "read", "hash")
+
+# Types of failures in the metrics by the status of an item
+FAILURE_TYPES = {"failed": "checksum", "warning": "integrity", "error": "error"}
+
+
+class Metrics:
+    """Aggregates the results of the items processed by a command and writes
+    them in the Prometheus text format, e.g. for the textfile collector of
+    node_exporter.
+
+    The durations of the `open`, `read` and `hash` phases of a file add up to
+    the observation of the hash histogram. All other phases except `fix` are
+    integrity checkers.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.monotonic()
+        self.files = Counter()
+        self.bytes = 0
+        self.hash = Histogram()
+        self.checkers = defaultdict(Histogram)
+        self._lock = threading.Lock()
+
+    def record(self, result):
+        with self._lock:
+            self.files[result["status"] or "ok"] += 1
+            self.bytes += result["bytes"]
+            hashing = None
+            for name, duration in result["durations"].items():
+                if name in READ_PHASES:
+                    hashing = (hashing or 0) + duration
+                elif name != "fix":
+                    self.checkers[name].observe(duration)
+            if hashing is not None:
+                self.hash.observe(hashing)
+
+    def lines(self):
+        """Yield the lines of the metrics file."""
+        labels = {"command": self.command}
+        failures = Counter()
+        for status, count in self.files.items():
+            if status in FAILURE_TYPES:
+                failures[FAILURE_TYPES[status]] += count
+
+        yield "# HELP beets_check_files_total Files processed by status."
+        yield "# TYPE beets_check_files_total counter"
+        for status, count in sorted(self.files.items()):
+            yield (
+                "beets_check_files_total"
+                f"{format_labels({**labels, 'status': status})} {count}"
+            )
+        yield "# HELP beets_check_bytes_read_total Bytes read by the plugin."
+        yield "# TYPE beets_check_bytes_read_total counter"
+        yield f"beets_check_bytes_read_total{format_labels(labels)} {self.bytes}"
+        yield "# HELP beets_check_failures_total Files that failed by type."
+        yield "# TYPE beets_check_failures_total counter"
+        for kind in ("checksum", "integrity", "error"):
+            yield (
+                "beets_check_failures_total"
+                f"{format_labels({**labels, 'type': kind})} {failures[kind]}"
+            )
+        yield "# HELP beets_check_run_duration_seconds Duration of the run."
+        yield "# TYPE beets_check_run_duration_seconds gauge"
+        yield (
+            f"beets_check_run_duration_seconds{format_labels(labels)} "
+            f"{time.monotonic() - self.started}"
+        )
+        yield "# HELP beets_check_last_run_timestamp_seconds End of the run."
+        yield "# TYPE beets_check_last_run_timestamp_seconds gauge"
+        yield (
+            f"beets_check_last_run_timestamp_seconds{format_labels(labels)} "
+            f"{time.time()}"
+        )
+        yield "# HELP beets_check_hash_duration_seconds Time to read and hash a file."
+        yield "# TYPE beets_check_hash_duration_seconds histogram"
+        yield from self.hash.samples("beets_check_hash_duration_seconds", labels)
+        yield (
+            "# HELP beets_check_checker_duration_seconds "
+            "Time an integrity checker took for a file."
+        )
+        yield "# TYPE beets_check_checker_duration_seconds histogram"
+        for name, histogram in sorted(self.checkers.items()):
+            yield from histogram.samples(
+                "beets_check_checker_duration_seconds",
+                {**labels, "checker": name},
+            )
+
+    def write(self, path):
+        """Write the metrics to `path` atomically, so that a collector never
+        reads a partial file.
+        """
+        with self._lock:
+            text = "".join(line + "\n" for line in self.lines())
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".", suffix=".tmp", delete=False
+        ) as file:
+            file.write(text)
+        # Temporary files are only readable by their owner, but collectors
+        # like the one of node_exporter usually run as a different user.
+        os.chmod(file.name, 0o644)
+        os.replace(file.name, path)
+
+
+def format_labels(labels):
+    """Format labels like `{command="check",status="ok"}`."""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Report:
+    """Writes a JSON record to `file` for each item as soon as it has been
+    processed.
+
+    Records are written one line at a time under a lock so that the lines of
+    concurrent workers don't interleave. Nothing is kept in memory.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class Progress:
+    """Progress indicator for the files processed by a command.
+
+    Workers call `start()` and `finish()` for each item, which only update
+    counters. `draw()` redraws the line at most every `interval` seconds. It
+    shows the number of files and bytes processed, the throughput, the
+    estimated time remaining and the file that has been in progress the
+    longest, which tells whether a run is limited by the disk or by a slow
+    tool. Nothing is drawn if `out` is None.
+    """
+
+    def __init__(self, msg, total=None, out=None, interval=0.25):
+        self.msg = msg
+        self.total = total
+        self.out = out
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._running = {}
+        self._lock = threading.Lock()
+        self._drawn = None
+        self._width = 0
+
+    def start(self, item):
+        with self._lock:
+            self._running[id(item)] = (item, time.monotonic())
+
+    def finish(self, item):
+        size = file_size(item) if isinstance(item, Item) else 0
+        with self._lock:
+            self._running.pop(id(item), None)
+            self.files += 1
+            self.bytes += size
+
+    def draw(self, force=False):
+        if self.out is None:
+            return
+        now = time.monotonic()
+        if not force and self._drawn is not None and now - self._drawn < self.interval:
+            return
+        self._drawn = now
+        line = self.line(now)
+        columns = shutil.get_terminal_size().columns - 1
+        if len(line) > columns:
+            line = line[: columns - 1] + "…"
+        self.out.write("\r" + line.ljust(self._width))
+        self.out.flush()
+        self._width = len(line)
+
+    def close(self):
+        """Draw the final state and end the line."""
+        if self.out is not None and self.files:
+            self.draw(force=True)
+            self.out.write("\n")
+            self.out.flush()
+
+    def line(self, now=None):
+        """Return the progress as a line of text."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            files, size = self.files, self.bytes
+            running = min(
+                self._running.values(), key=operator.itemgetter(1), default=None
+            )
+        elapsed = max(now - self.started, 1e-6)
+        files_rate = files / elapsed
+        count = f"{files}"
+        if self.total:
+            count += f"/{self.total} [{files * 100 // self.total}%]"
+        parts = [
+            f"{self.msg}: {count}",
+            format_size(size),
+            f"{format_size(size / elapsed)}/s",
+            f"{files_rate:.1f} files/s",
+        ]
+        if self.total and files and files < self.total:
+            eta = (self.total - files) / files_rate
+            parts.append(f"ETA {format_duration(eta)}")
+        if running:
+            item, started = running
+            parts.append(
+                f"slowest {format_duration(now - started)} "
+                f"{displayable_path(getattr(item, 'path', item))}"
+            )
+        return ", ".join(parts)
+
+
+class ItemWriter:
+    """Store items in batched transactions from a single thread.
+
+    Worker threads only compute checksums and hand the items to `store()`.
+    The writer thread commits them in transactions of at most `batch_size`
+    items or `interval` seconds so that workers don't contend for the
+    database lock and we don't pay for one commit per file.
+    """
+
+    def __init__(self, lib, batch_size, interval):
+        self.lib = lib
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=4 * self.batch_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="check-writer")
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def store(self, item):
+        self._queue.put(item)
+
+    async def store_async(self, item):
+        """Like `store` but waits for room in the queue without blocking the
+        event loop.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.to_thread(self._queue.put, item)
+
+    def call(self, func):
+        """Call `func` on the writer thread after all items stored before
+        have been committed.
+        """
+        self._queue.put(func)
+
+    def close(self):
+        """Store all pending items and stop the writer thread.
+
+        Raises the first exception that occurred while storing items.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        closed = False
+        while not closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            # A function ends the batch so that it's called without delay.
+            while not callable(batch[-1]) and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            if self._error:
+                # Keep consuming the queue so that workers don't block.
+                continue
+            try:
+                with profiled("commit"), self.lib.transaction():
+                    for item in batch:
+                        if not callable(item):
+                            with profiled("store"):
+                                item.store()
+                if callable(batch[-1]):
+                    batch[-1]()
+            except Exception as exc:
+                self._error = exc
+
+
+class Checkpoint:
+    """Records the items a run has finished so that it can be resumed after
+    it was interrupted.
+
+    The file starts with a JSON line that describes the run, followed by a
+    line for each checkpoint with the IDs of the items finished since the
+    previous checkpoint and the number of failures among them. Checkpoints are
+    written by the `ItemWriter` once the changes to these items have been
+    committed. If the file describes the same run, `done` and `failures`
+    are restored from it.
+    """
+
+    def __init__(self, path, run, writer, interval):
+        self.path = path
+        self.writer = writer
+        self.interval = max(interval, 1)
+        self.done = set()
+        self.failures = 0
+        self._ids = []
+        self._failures = 0
+        self._lock = threading.Lock()
+
+        header = json.dumps(run, sort_keys=True)
+        try:
+            with open(path) as file:  # noqa: FURB101
+                lines = file.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        if lines and lines[0] == header:
+            for line in lines[1:]:
+                try:
+                    ids, failures = json.loads(line)
+                except ValueError:
+                    # Interrupted while writing the last checkpoint
+                    break
+                self.done.update(ids)
+                self.failures += failures
+        with open(path, "w") as file:
+            file.write(header + "\n")
+            if self.done:
+                file.write(json.dumps([sorted(self.done), self.failures]) + "\n")
+
+    def finished(self, item_id, failures=0):
+        with self._lock:
+            self._ids.append(item_id)
+            self._failures += failures
+            if len(self._ids) >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """Write a checkpoint for the items finished so far."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._ids:
+            return
+        line = json.dumps([self._ids, self._failures]) + "\n"
+        self._ids = []
+        self._failures = 0
+        self.writer.call(lambda: self._append(line))
+
+    def _append(self, line):
+        with open(self.path, "a") as file:
+            file.write(line)
+            file.flush()
+            os.fsync(file.fileno())
+
+    def complete(self):
+        """Remove the file after the run has finished."""
+        with self._lock:
+            self._ids = []
+
+        def remove():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+        self.writer.call(remove)
 
 
 class IntegrityError(ReadError):
+    # Name of the checker that found the error
+    checker = None
+
     def __str__(self):
         return f"error reading {displayable_path(self.path)}: {self.reason}"
 
@@ -517,6 +2568,13 @@ class IntegrityChecker:
         cls._all = []
         for name, tool in config["check"]["external"].items():
             cls._all.append(cls(name, tool))
+        for name in config["check"]["builtin"].as_str_seq():
+            builtin = BuiltinChecker(name)
+            # The replaced tool is still used to fix files.
+            for checker in cls._all:
+                if checker.name == builtin.validator.replaces:
+                    checker.replaced = True
+            cls._all.append(builtin)
         return cls._all
 
     @classmethod
@@ -525,9 +2583,42 @@ class IntegrityChecker:
             cls._all_available = [c for c in cls.all() if c.available()]
         return cls._all_available
 
+    @classmethod
+    def checking(cls):
+        """Return the available checkers that check files, leaving out tools
+        that are replaced by a built-in checker.
+        """
+        return [c for c in cls.allAvailable() if not getattr(c, "replaced", False)]
+
     def __init__(self, name, config):
         self.name = name
+        # Set if a built-in checker checks files instead of this tool
+        self.replaced = False
+        self._fingerprint = None
         self.cmdline = config["cmdline"].get(str)
+        self.args = shlex.split(self.cmdline)
+
+        if config["batch"].exists():
+            self.batch = config["batch"].get(int)
+            if not any(arg in ("{0}", "{}") for arg in self.args):
+                raise UserError(
+                    f"check.external.{name}: the placeholder must be a separate "
+                    "argument to check files in batches"
+                )
+        else:
+            self.batch = 0
+        if config["batch_length"].exists():
+            self.batch_length = config["batch_length"].get(int)
+        else:
+            self.batch_length = 128 * 1024
+        self._pending = []
+        self._pending_length = 0
+        self._batch_tasks = set()
+
+        if config["stdin"].exists():
+            self.stdin_args = shlex.split(config["stdin"].get(str))
+        else:
+            self.stdin_args = None
 
         if config["formats"].exists():
             self.formats = config["formats"].as_str_seq()
@@ -541,11 +2632,42 @@ class IntegrityChecker:
 
         if config["fix"].exists():
             self.fixcmd = config["fix"].get(str)
+            self.fix_args = shlex.split(self.fixcmd)
         else:
             self.fixcmd = False
 
     def available(self) -> bool:
-        return shutil.which(self.cmdline.split(" ")[0]) is not None
+        return shutil.which(self.args[0]) is not None
+
+    def fingerprint(self):
+        """Return a string that changes when the tool or its configuration
+        changes.
+
+        We use the size and modification time of the executable instead of
+        the version reported by the tool so we don't have to run it.
+        """
+        if self._fingerprint is None:
+            path = shutil.which(self.args[0])
+            stat = os.stat(path)
+            data = f"{self.cmdline}\0{path}\0{stat.st_size}\0{stat.st_mtime_ns}"
+            self._fingerprint = sha256(data.encode()).hexdigest()[:16]
+        return self._fingerprint
+
+    def command(self, args, item):
+        """Return the argument list `args` with the placeholder `{0}` (or `{}`)
+        replaced by the path of the item.
+
+        The path is passed as is to the tool, so it doesn't need to be quoted
+        or decodable.
+        """
+        path = syspath(item.path)
+        if isinstance(path, bytes):
+            return [
+                os.fsencode(arg).replace(b"{0}", path).replace(b"{}", path)
+                for arg in args
+            ]
+        else:
+            return [arg.replace("{0}", path).replace("{}", path) for arg in args]
 
     @classmethod
     def fixer(cls, item):
@@ -560,21 +2682,182 @@ class IntegrityChecker:
     def check(self, item):
         if not self.can_check(item):
             return
-        process = Popen(
-            self.cmdline.format(self.shellquote(item.path.decode("utf-8"))),
-            shell=True,
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=STDOUT,
+        with profiled("spawn"):
+            process = Popen(
+                self.command(self.args, item),
+                stdin=PIPE,
+                stdout=PIPE,
+                stderr=STDOUT,
+            )
+        with profiled("wait"):
+            stdout = process.communicate()[0]
+        self.check_output(item, process.returncode, stdout)
+
+    def stream(self, item):
+        """Start the tool reading the file from stdin.
+
+        Returns a `ToolStream` that is fed by `verify_all()`, or `None` if the
+        tool is not configured with `stdin`.
+        """
+        if not self.stdin_args:
+            return None
+        return ToolStream(self, item)
+
+    async def check_async(self, item, processes=None):
+        """Check the item without blocking the event loop.
+
+        If the checker is configured with `batch` the item is added to the
+        pending batch and checked together with other items once the batch
+        is full or `flush()` is called.
+        """
+        if not self.can_check(item):
+            return
+        if self.batch:
+            await self.add_to_batch(item, processes)
+            return
+        async with processes or contextlib.nullcontext():
+            returncode, stdout = await self.run_async(self.command(self.args, item))
+        self.check_output(item, returncode, stdout)
+
+    async def run_async(self, args):
+        with profiled("spawn"):
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdin=PIPE,
+                stdout=PIPE,
+                stderr=STDOUT,
+            )
+        with profiled("wait"):
+            stdout = (await process.communicate())[0]
+        return process.returncode, stdout
+
+    def add_to_batch(self, item, processes):
+        """Add the item to the pending batch and return a future that
+        resolves when the item has been checked.
+        """
+        length = len(os.fsencode(syspath(item.path))) + 1
+        if self._pending and self._pending_length + length > self.batch_length:
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        self._pending_length += length
+        self._processes = processes
+        if len(self._pending) >= self.batch:
+            self.flush()
+        return future
+
+    def waiting(self):
+        """Return the number of items in the pending batch."""
+        return len(self._pending)
+
+    def flush(self):
+        """Start checking the items of the pending batch."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._pending_length = 0
+        task = asyncio.create_task(self.check_batch(batch, self._processes))
+        # Keep a reference so that the task is not garbage collected
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def check_batch(self, batch, processes):
+        """Run the tool once for all items in `batch` and resolve their
+        futures.
+
+        Errors are assigned to items by looking for the item's path in the
+        output line that matches `error`. If an error cannot be assigned to
+        an item or the tool fails without matching `error`, we fall back to
+        checking the items one by one.
+        """
+        items = [item for item, _ in batch]
+        try:
+            async with processes or contextlib.nullcontext():
+                returncode, stdout = await self.run_async(self.batch_command(items))
+            errors, unassigned = self.batch_errors(items, stdout)
+            if unassigned or (returncode and not errors):
+                log.debug(
+                    f"{self.name}: checking batch of {len(items)} files one by one"
+                )
+                for item, future in batch:
+                    try:
+                        async with processes or contextlib.nullcontext():
+                            returncode, stdout = await self.run_async(
+                                self.command(self.args, item)
+                            )
+                        self.check_output(item, returncode, stdout)
+                    except Exception as exc:
+                        future.set_exception(exc)
+                    else:
+                        future.set_result(None)
+                return
+            for index, (item, future) in enumerate(batch):
+                if index in errors:
+                    future.set_exception(IntegrityError(item.path, errors[index]))
+                else:
+                    future.set_result(None)
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+
+    def batch_command(self, items):
+        """Return the argument list with the placeholder replaced by the
+        paths of all items.
+        """
+        paths = [syspath(item.path) for item in items]
+        args = []
+        for arg in self.args:
+            if arg in ("{0}", "{}"):
+                args.extend(paths)
+            elif paths and isinstance(paths[0], bytes):
+                args.append(os.fsencode(arg))
+            else:
+                args.append(arg)
+        return args
+
+    def batch_errors(self, items, stdout):
+        """Return a dictionary that maps the index of an item to the error
+        reported for it, and whether some errors could not be assigned to an
+        item.
+        """
+        errors = {}
+        unassigned = False
+        if not self.error_match:
+            return errors, unassigned
+        # Longest paths first so that a path that is a prefix of another path
+        # does not match the wrong line.
+        paths = sorted(
+            (
+                (os.fsencode(syspath(item.path)), index)
+                for index, item in enumerate(items)
+            ),
+            key=lambda p: len(p[0]),
+            reverse=True,
         )
-        stdout = process.communicate()[0]
+        for line in stdout.splitlines():
+            match = self.error_match.search(line.decode("utf-8", "replace"))
+            if not match:
+                continue
+            for path, index in paths:
+                if path in line:
+                    errors.setdefault(index, match.group(1))
+                    break
+            else:
+                unassigned = True
+        return errors, unassigned
+
+    def check_output(self, item, returncode, stdout):
+        """Raise an `IntegrityError` if the output or the exit code of the
+        tool indicate an error.
+        """
         if self.error_match:
-            match = self.error_match.search(stdout.decode("utf-8"))
+            match = self.error_match.search(stdout.decode("utf-8", "replace"))
         else:
             match = False
         if match:
             raise IntegrityError(item.path, match.group(1))
-        elif process.returncode:
+        elif returncode:
             raise IntegrityError(item.path, f"non-zero exit code for {self.name}")
 
     def can_fix(self, item):
@@ -583,12 +2866,822 @@ class IntegrityChecker:
     def fix(self, item):
         assert isinstance(self.fixcmd, str)
         check_call(
-            self.fixcmd.format(self.shellquote(item.path.decode("utf-8"))),
-            shell=True,
+            self.command(self.fix_args, item),
             stdin=PIPE,
             stdout=PIPE,
             stderr=STDOUT,
         )
 
-    def shellquote(self, s):
-        return "'" + s.replace("'", r"'\''") + "'"
+
+class ToolStream:
+    """Passes a file to the stdin of an external tool while it is read."""
+
+    def __init__(self, checker, item):
+        self.checker = checker
+        self.item = item
+        # A file instead of a pipe, so the tool never blocks on its output
+        # while we are writing to its input.
+        self.output = tempfile.TemporaryFile()  # noqa: SIM115
+        with profiled("spawn"):
+            self.process = Popen(
+                checker.stdin_args, stdin=PIPE, stdout=self.output, stderr=STDOUT
+            )
+        self.done = False
+
+    def update(self, data):
+        if self.done:
+            return
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            # The tool stopped reading, its output tells us why.
+            self.finish()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        with contextlib.suppress(BrokenPipeError):
+            self.process.stdin.close()
+        with profiled("wait"):
+            returncode = self.process.wait()
+        self.output.seek(0)
+        stdout = self.output.read()
+        self.output.close()
+        self.checker.check_output(self.item, returncode, stdout)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.output.close()
+
+
+class BuiltinChecker:
+    """Integrity checker that validates the structure of files in-process
+    with a `StreamValidator` instead of running an external tool.
+    """
+
+    def __init__(self, name):
+        try:
+            self.validator = VALIDATORS[name]
+        except KeyError:
+            raise UserError(f"check.builtin: unknown checker {name}") from None
+        self.name = f"{name} (built-in)"
+
+    def available(self) -> bool:
+        return True
+
+    def fingerprint(self):
+        return f"built-in {self.validator.version}"
+
+    def can_check(self, item):
+        return item.format in self.validator.formats
+
+    def can_fix(self, item):
+        return False
+
+    def check(self, item):
+        if not self.can_check(item):
+            return
+        validator = self.validator()
+        try:
+            for chunk in read_chunks(syspath(item.path)):
+                validator.update(chunk)
+            validator.finish()
+        except FormatError as exc:
+            raise IntegrityError(item.path, str(exc)) from None
+
+    def stream(self, item):
+        """Return a validator for the item's file that is fed by
+        `verify_all()`.
+        """
+        return self.validator()
+
+
+class FormatError(Exception):
+    """Raised by a `StreamValidator` if the file is malformed."""
+
+    def __init__(self, reason, offset):
+        super().__init__(reason, offset)
+        self.reason = reason
+        self.offset = offset
+
+    def __str__(self):
+        return f"{self.reason} (offset 0x{self.offset:x})"
+
+
+class StreamValidator:
+    """Validates the structure of a file while it is read.
+
+    The file is passed to `update()` in chunks of any size and `finish()` is
+    called at the end of the file. Subclasses parse the file with a chain of
+    state methods, starting with `start()`. Each state consumes data from
+    `buffer` at `pos` and returns `True` to continue with the next state or
+    `False` if it needs more data. Positions are file offsets, `buffer[0]` is
+    at `offset`. Data before `consumed()` is discarded.
+    """
+
+    formats = ()
+    # Increased when the validator detects more errors, so that cached
+    # results are discarded.
+    version = 1
+    # Name of the external tool that is not needed to check files anymore
+    replaces = None
+    # Reason reported if the file ends early
+    truncated = "file is truncated"
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.pos = 0
+        self.eof = False
+        self.state = self.start
+
+    def update(self, data):
+        self.buffer += data
+        self.parse()
+        # Don't discard data that hasn't been received yet when the parser
+        # skips past the end of the buffer.
+        discard = min(self.consumed() - self.offset, len(self.buffer))
+        del self.buffer[:discard]
+        self.offset += discard
+
+    def finish(self):
+        self.eof = True
+        self.parse()
+
+    def parse(self):
+        while self.state():
+            pass
+
+    def start(self):
+        raise NotImplementedError
+
+    def consumed(self):
+        return self.pos
+
+    @property
+    def end(self):
+        """File offset of the end of the buffered data."""
+        return self.offset + len(self.buffer)
+
+    def available(self, length):
+        """Return whether `length` bytes from `pos` are buffered.
+
+        Raises `FormatError` if they never will be.
+        """
+        if self.end >= self.pos + length:
+            return True
+        if self.eof:
+            raise FormatError(self.truncated, self.pos)
+        return False
+
+    def peek(self, length):
+        start = self.pos - self.offset
+        return self.buffer[start : start + length]
+
+    def read(self, length):
+        data = self.peek(length)
+        self.pos += length
+        return data
+
+    def skip_id3v2(self):
+        """Skip an ID3v2 tag at `pos`.
+
+        Returns `True` if a tag was skipped, `False` if there is none and
+        `None` if more data is needed.
+        """
+        if not self.available(3):
+            return None
+        if self.peek(3) != b"ID3":
+            return False
+        if not self.available(10):
+            return None
+        header = self.read(10)
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        # Footer present
+        if header[5] & 0x10:
+            size += 10
+        self.pos += size
+        return True
+
+
+def _crc8_table(poly):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+def _crc16_table(poly):
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+
+FLAC_CRC8 = _crc8_table(0x07)
+CRC16 = _crc16_table(0x8005)
+_crc16_words = None
+
+
+def flac_crc8(data):
+    crc = 0
+    for byte in data:
+        crc = FLAC_CRC8[crc ^ byte]
+    return crc
+
+
+def crc16(data, crc=0):
+    """Return the CRC-16 with the polynomial 0x8005 used by FLAC and MPEG
+    audio frames, continuing from `crc`.
+
+    The data is processed two bytes at a time with a table of all 65536
+    words, which is about twice as fast as the usual byte-wise table in pure
+    Python.
+    """
+    global _crc16_words
+    if _crc16_words is None:
+        table = CRC16
+        _crc16_words = array(
+            "H",
+            [
+                ((table[high] << 8) & 0xFFFF) ^ table[(table[high] >> 8) ^ low]
+                for high in range(256)
+                for low in range(256)
+            ],
+        )
+    if len(data) % 2:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16[(crc >> 8) ^ data[0]]
+        data = data[1:]
+    words = array("H")
+    words.frombytes(data)
+    if sys.byteorder == "little":
+        words.byteswap()
+    table = _crc16_words
+    for word in words:
+        crc = table[crc ^ word]
+    return crc
+
+
+# Block sizes for the block size codes 1-5 and 8-15 of a FLAC frame header.
+FLAC_BLOCK_SIZES = {
+    1: 192,
+    **{code: 576 << (code - 2) for code in range(2, 6)},
+    **{code: 256 << (code - 8) for code in range(8, 16)},
+}
+
+
+class FlacValidator(StreamValidator):
+    """Checks the STREAMINFO block, the header of every frame and the CRCs
+    of headers and frames of a FLAC file without decoding the audio.
+
+    Frames don't store their length, so the end of a frame is found by
+    looking for the next valid frame header: the sync code followed by a
+    header with a valid CRC-8 and the expected frame or sample number. The
+    CRC-16 of the frame is then compared with the two bytes before it.
+    """
+
+    formats = ("FLAC",)
+
+    def __init__(self):
+        super().__init__()
+        self.total_samples = 0
+        self.max_frame_size = 0
+        self.samples = 0
+        # The current frame: its offset and parsed header
+        self.frame = None
+        self.frame_start = 0
+        # CRC-16 of the current frame up to `crc_pos`
+        self.crc = 0
+        self.crc_pos = 0
+        # Where to continue looking for the next frame header
+        self.scan = 0
+
+    def consumed(self):
+        if self.frame is None:
+            return self.pos
+        return self.crc_pos
+
+    def start(self):
+        # ID3v2 tags are not part of the FLAC format, but common.
+        skipped = self.skip_id3v2()
+        if skipped is None:
+            return False
+        if skipped:
+            return True
+        if not self.available(4):
+            return False
+        if self.read(4) != b"fLaC":
+            raise FormatError("not a FLAC stream", self.pos - 4)
+        self.state = self.parse_streaminfo
+        return True
+
+    def parse_streaminfo(self):
+        if not self.available(38):
+            return False
+        start = self.pos
+        header = self.read(4)
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        if block_type != 0 or length != 34:
+            raise FormatError("missing STREAMINFO block", start)
+        info = self.read(34)
+        self.max_frame_size = int.from_bytes(info[7:10], "big")
+        self.total_samples = int.from_bytes(info[13:18], "big") & 0xFFFFFFFFF
+        self.state = self.parse_metadata if header[0] < 0x80 else self.parse_frames
+        return True
+
+    def parse_metadata(self):
+        if not self.available(4):
+            return False
+        start = self.pos
+        header = self.read(4)
+        if header[0] & 0x7F in (0, 127):
+            raise FormatError("invalid metadata block", start)
+        self.pos += int.from_bytes(header[1:4], "big")
+        if header[0] & 0x80:
+            self.state = self.parse_frames
+        return True
+
+    def parse_frames(self):
+        if self.frame is None:
+            if self.eof and self.pos == self.end and not self.total_samples:
+                # A stream without audio
+                return False
+            if not self.available(2):
+                return False
+            header = self.frame_header(self.pos)
+            if header is None:
+                return False
+            if header is False:
+                raise FormatError("invalid frame header", self.pos)
+            self.start_frame(self.pos, header)
+
+        buffer = self.buffer
+        limit = 2 * self.max_frame_size or 16 * 1024 * 1024
+        while True:
+            index = buffer.find(b"\xff", self.scan - self.offset)
+            if index < 0:
+                self.scan = self.end
+                break
+            candidate = self.offset + index
+            header = self.frame_header(candidate)
+            if header is None:
+                self.scan = candidate
+                break
+            if header is False or not self.follows(header):
+                self.scan = candidate + 1
+                continue
+            self.end_frame(candidate)
+            self.start_frame(candidate, header)
+
+        if self.eof:
+            self.end_stream()
+            return False
+        if self.scan - self.frame_start > limit:
+            raise FormatError("lost sync", self.frame_start)
+        # Keep the two bytes before the next frame, which hold the CRC of this
+        # frame, and enough data to find an ID3v1 tag at the end of the file.
+        self.update_crc(self.scan - 130)
+        return False
+
+    def frame_header(self, pos):
+        """Parse the frame header at `pos`.
+
+        Returns a tuple `(length, variable, number, block_size)`, `False` if
+        there is no valid header at `pos` or `None` if more data is needed.
+        """
+        buffer = self.buffer
+        start = pos - self.offset
+        available = len(buffer) - start
+        if available < 6:
+            return False if self.eof else None
+        b0, b1, b2, b3, first = buffer[start : start + 5]
+        if b0 != 0xFF or b1 & 0xFE != 0xF8:
+            return False
+        block_code = b2 >> 4
+        rate_code = b2 & 0x0F
+        if block_code == 0 or rate_code == 15 or b3 >> 4 > 10 or b3 & 0x0F in (6, 7):
+            return False
+        if b3 & 0x01:
+            return False
+
+        # Frame or sample number, coded like UTF-8
+        if first < 0x80:
+            extra, number = 0, first
+        elif 0xC0 <= first < 0xFF:
+            extra = 7 - (first ^ 0xFF).bit_length()
+            number = first & (0x3F >> extra)
+        else:
+            return False
+        length = 4 + 1 + extra
+        length += {6: 1, 7: 2}.get(block_code, 0)
+        length += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+        if available < length + 1:
+            return False if self.eof else None
+        for byte in buffer[start + 5 : start + 5 + extra]:
+            if byte & 0xC0 != 0x80:
+                return False
+            number = (number << 6) | (byte & 0x3F)
+        if flac_crc8(buffer[start : start + length]) != buffer[start + length]:
+            return False
+
+        if block_code == 6:
+            block_size = buffer[start + 5 + extra] + 1
+        elif block_code == 7:
+            index = start + 5 + extra
+            block_size = int.from_bytes(buffer[index : index + 2], "big") + 1
+        else:
+            block_size = FLAC_BLOCK_SIZES[block_code]
+        return (length + 1, b1 & 0x01, number, block_size)
+
+    def follows(self, header):
+        """Return whether the frame with `header` follows the current frame."""
+        _, variable, number, _ = header
+        _, current_variable, current_number, block_size = self.frame
+        if variable != current_variable:
+            return False
+        if variable:
+            return number == current_number + block_size
+        return number == current_number + 1
+
+    def start_frame(self, pos, header):
+        self.frame = header
+        self.frame_start = pos
+        self.crc = 0
+        self.crc_pos = pos
+        self.scan = pos + header[0]
+
+    def update_crc(self, pos):
+        if pos > self.crc_pos:
+            start = self.crc_pos - self.offset
+            self.crc = crc16(self.buffer[start : pos - self.offset], self.crc)
+            self.crc_pos = pos
+
+    def frame_crc_matches(self, end):
+        self.update_crc(end - 2)
+        stored = self.buffer[end - 2 - self.offset : end - self.offset]
+        return self.crc == int.from_bytes(stored, "big")
+
+    def end_frame(self, end):
+        if not self.frame_crc_matches(end):
+            raise FormatError("frame CRC mismatch", self.frame_start)
+        self.samples += self.frame[3]
+
+    def end_stream(self):
+        end = self.end
+        tag = end - 128 - self.offset
+        if end - 128 >= self.crc_pos and self.buffer[tag : tag + 3] == b"TAG":
+            # ID3v1 tag
+            end -= 128
+        if end - self.frame_start < self.frame[0] + 2 or not self.frame_crc_matches(
+            end
+        ):
+            raise FormatError(
+                "frame CRC mismatch in last frame, file may be truncated",
+                self.frame_start,
+            )
+        self.samples += self.frame[3]
+        if self.samples < self.total_samples:
+            raise FormatError("file is truncated", end)
+        if self.total_samples and self.samples != self.total_samples:
+            raise FormatError(
+                f"stream has {self.samples} samples, STREAMINFO says "
+                f"{self.total_samples}",
+                end,
+            )
+
+
+# Bit rates in kbit/s by MPEG version (1 or 2, which includes 2.5), layer and
+# bit rate index.
+MPEG_BIT_RATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# Sample rates by the version bits of the frame header and sample rate index
+MPEG_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),  # MPEG 2.5
+    2: (22050, 24000, 16000),  # MPEG 2
+    3: (44100, 48000, 32000),  # MPEG 1
+}
+
+
+def mpeg_frame_header(header):
+    """Parse the four byte MPEG audio frame header.
+
+    Returns a tuple `(length, stream, protected, side_info)` or `None` if the
+    header is invalid. `stream` identifies the version, layer and sample rate,
+    which must not change within a file. `side_info` is the length of the
+    layer III side information.
+    """
+    b0, b1, b2, b3 = header
+    if b0 != 0xFF or b1 < 0xE0:
+        return None
+    version_bits = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bit_rate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    # Reserved values, free format bit rate and reserved emphasis
+    if (
+        version_bits == 1
+        or layer == 4
+        or bit_rate_index in (0, 15)
+        or sample_rate_index == 3
+        or b3 & 0x03 == 2
+    ):
+        return None
+    version = 1 if version_bits == 3 else 2
+    bit_rate = MPEG_BIT_RATES[version, layer][bit_rate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version_bits][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    if layer == 1:
+        length = (12 * bit_rate // sample_rate + padding) * 4
+    elif layer == 3 and version == 2:
+        length = 72 * bit_rate // sample_rate + padding
+    else:
+        length = 144 * bit_rate // sample_rate + padding
+    mono = b3 >> 6 == 3
+    if version == 1:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    stream = (version_bits, layer, sample_rate)
+    return (length, stream, not b1 & 0x01, side_info)
+
+
+class Mp3Validator(StreamValidator):
+    """Walks the frames of an MPEG audio file and checks that they follow
+    each other without gaps, that the file doesn't end in the middle of a
+    frame and that the frame count in a Xing or VBRI header is correct.
+
+    The CRCs of protected layer III frames are checked as well. ID3v2 tags at
+    the start and ID3v1 and APEv2 tags at the end are skipped. The reasons
+    match those reported by mp3val.
+    """
+
+    formats = ("MP3",)
+    replaces = "mp3val"
+    truncated = (
+        "It seems that file is truncated or there is garbage at the end of the file"
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.stream = None
+        self.frames = 0
+        # Offset of the Xing or VBRI header, its name and frame count
+        self.vbr_header = None
+        # Offset of unexpected data and where to continue looking for a frame
+        self.junk = 0
+        self.scan = 0
+
+    def consumed(self):
+        if self.state == self.parse_junk:
+            return self.scan
+        return self.pos
+
+    def start(self):
+        skipped = self.skip_id3v2()
+        if skipped is None:
+            return False
+        if not skipped:
+            self.state = self.parse_frame
+        return True
+
+    def parse_frame(self):
+        if self.eof and self.pos == self.end:
+            self.end_stream()
+            return False
+        if not self.available(4):
+            return False
+        header = self.peek(4)
+        if (self.stream and header[:3] == b"TAG") or header == b"APET":
+            self.state = self.parse_tag
+            return True
+        frame = mpeg_frame_header(header)
+        if frame is None or (self.stream and frame[1] != self.stream):
+            if frame and self.stream and frame[1][:2] != self.stream[:2]:
+                raise FormatError(
+                    "Different MPEG versions or layers in one file", self.pos
+                )
+            self.junk = self.pos
+            self.scan = self.pos + 1
+            self.state = self.parse_junk
+            return True
+        length, stream, protected, side_info = frame
+        if not self.available(length):
+            return False
+        data = self.peek(length)
+        if protected and stream[1] == 3:
+            crc = crc16(data[2:4] + data[6 : 6 + side_info], 0xFFFF)
+            if crc != int.from_bytes(data[4:6], "big"):
+                raise FormatError("Wrong CRC in frame", self.pos)
+        if self.stream is None:
+            self.stream = stream
+            if self.parse_vbr_header(data, 4 + 2 * protected + side_info):
+                self.pos += length
+                return True
+        self.frames += 1
+        self.pos += length
+        return True
+
+    def parse_vbr_header(self, frame, offset):
+        """Look for a Xing or VBRI header in the first frame.
+
+        Returns `True` if there is one. The frame is not an audio frame then.
+        """
+        if frame[offset : offset + 4] in (b"Xing", b"Info"):
+            flags = int.from_bytes(frame[offset + 4 : offset + 8], "big")
+            count = None
+            if flags & 0x01:
+                count = int.from_bytes(frame[offset + 8 : offset + 12], "big")
+            self.vbr_header = (self.pos, "Xing", count)
+            return True
+        if frame[36:40] == b"VBRI":
+            count = int.from_bytes(frame[50:54], "big")
+            self.vbr_header = (self.pos, "VBRI", count)
+            return True
+        return False
+
+    def parse_junk(self):
+        buffer = self.buffer
+        while True:
+            index = buffer.find(b"\xff", self.scan - self.offset)
+            if index < 0:
+                self.scan = self.end
+                break
+            candidate = self.offset + index
+            if candidate + 4 > self.end:
+                self.scan = candidate
+                break
+            frame = mpeg_frame_header(buffer[index : index + 4])
+            if frame is None or (self.stream and frame[1] != self.stream):
+                self.scan = candidate + 1
+                continue
+            if self.stream is None:
+                raise FormatError("Garbage at the beginning of the file", self.junk)
+            raise FormatError(
+                "MPEG stream error, resynchronized successfully", self.junk
+            )
+        if self.eof:
+            if self.stream is None:
+                raise FormatError("No MPEG frames found", self.junk)
+            raise FormatError(self.truncated, self.junk)
+        return False
+
+    def parse_tag(self):
+        if self.eof and self.pos == self.end:
+            self.end_stream()
+            return False
+        if not self.available(3):
+            return False
+        if self.peek(3) == b"TAG":
+            if not self.available(128):
+                return False
+            self.pos += 128
+            return True
+        if not self.available(32):
+            return False
+        header = self.peek(32)
+        if header[:8] != b"APETAGEX":
+            raise FormatError(self.truncated, self.pos)
+        # The size includes the footer but not the header.
+        size = int.from_bytes(header[12:16], "little")
+        is_header = int.from_bytes(header[20:24], "little") & (1 << 29)
+        self.pos += size + 32 if is_header else 32
+        return True
+
+    def end_stream(self):
+        if self.stream is None:
+            raise FormatError("No MPEG frames found", self.pos)
+        if self.vbr_header:
+            offset, name, count = self.vbr_header
+            if count is not None and count != self.frames:
+                raise FormatError(
+                    f"Wrong number of MPEG frames specified in {name} header "
+                    f"({count} instead of {self.frames})",
+                    offset,
+                )
+
+
+# Reverses the bits of each byte
+_REVERSE_BITS = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+
+def ogg_crc32(data):
+    """Return the CRC-32 of an Ogg page.
+
+    Ogg uses the polynomial of `zlib.crc32` but without reflecting the bits
+    and without the initial and final inversion. We compute it with
+    `zlib.crc32` on the bit reversed data, which is much faster than a table
+    in pure Python.
+    """
+    crc = ~zlib.crc32(data.translate(_REVERSE_BITS), 0xFFFFFFFF) & 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+
+_ogg_page_header = struct.Struct("<4sBBqIIIB")
+
+
+class OggValidator(StreamValidator):
+    """Checks the CRC of every page of an Ogg file and that the pages of each
+    logical stream are complete and in order.
+    """
+
+    formats = ("OGG", "Opus")
+    replaces = "oggz-validate"
+
+    def __init__(self):
+        super().__init__()
+        # Sequence number and granule position of the last page, whether the
+        # last packet continues on the next page, and whether the stream
+        # ended, by serial number
+        self.streams = {}
+
+    def start(self):
+        if self.eof and self.pos == self.end:
+            self.end_stream()
+            return False
+        if not self.available(27):
+            return False
+        (
+            capture,
+            version,
+            flags,
+            granule,
+            serial,
+            sequence,
+            crc,
+            count,
+        ) = _ogg_page_header.unpack(self.peek(27))
+        if capture != b"OggS":
+            if self.pos == 0:
+                raise FormatError("not an Ogg stream", self.pos)
+            raise FormatError("lost sync", self.pos)
+        if version != 0:
+            raise FormatError(f"unsupported Ogg version {version}", self.pos)
+        if not self.available(27 + count):
+            return False
+        segments = self.peek(27 + count)[27:]
+        length = 27 + count + sum(segments)
+        if not self.available(length):
+            return False
+        page = bytearray(self.peek(length))
+        page[22:26] = bytes(4)
+        if ogg_crc32(page) != crc:
+            raise FormatError("page CRC mismatch", self.pos)
+        self.check_continuity(flags, granule, serial, sequence, segments)
+        self.pos += length
+        return True
+
+    def check_continuity(self, flags, granule, serial, sequence, segments):
+        continued = bool(flags & 0x01)
+        # Chained files may reuse the serial number of a stream that ended.
+        if serial not in self.streams or (self.streams[serial][3] and flags & 0x02):
+            if not flags & 0x02:
+                raise FormatError("page of unknown stream", self.pos)
+        elif flags & 0x02:
+            raise FormatError("beginning of stream page in stream", self.pos)
+        else:
+            last_sequence, last_granule, last_continues, ended = self.streams[serial]
+            if ended:
+                raise FormatError("page after end of stream", self.pos)
+            if sequence != last_sequence + 1:
+                raise FormatError(
+                    f"page sequence number {sequence} does not follow {last_sequence}",
+                    self.pos,
+                )
+            if granule != -1 and granule < last_granule:
+                raise FormatError("granule position decreases", self.pos)
+            if continued != last_continues:
+                raise FormatError("packet continuation mismatch", self.pos)
+            if granule == -1:
+                granule = last_granule
+        # A packet continues on the next page if the last segment is full.
+        continues = bool(segments) and segments[-1] == 255
+        self.streams[serial] = (sequence, granule, continues, bool(flags & 0x04))
+
+    def end_stream(self):
+        if not self.streams:
+            raise FormatError("not an Ogg stream", self.pos)
+        if not all(ended for *_, ended in self.streams.values()):
+            raise FormatError("file is truncated, end of stream page missing", self.pos)
+
+
+# Stream validators by the name used in the `builtin` option.
+VALIDATORS = {"flac": FlacValidator, "mp3": Mp3Validator, "ogg": OggValidator}
@@ -0,0 +1,305 @@
+"""Benchmark the commands of the check plugin on a synthetic library.
+
+Run `python -m test.benchmark --help` from the repository root for the
+options. See DEVELOPMENT.md for details.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import beets
+import beets.library
+import beets.ui
+from beets.library import Item
+from beets.util import bytestring_path
+
+from beetsplug import check
+
+# Modes in the order they run. Each mode runs on the library as the previous
+# modes left it, so `add` has to come first.
+MODES = {
+    "add": ["--add"],
+    "check": [],
+    "quick": ["--quick"],
+    "update": ["--update", "--force"],
+    "external": ["--external"],
+    "all": ["--all"],
+    "export": ["--export"],
+    "fix": ["--fix", "--force"],
+}
+
+FORMATS = {"mp3": "MP3", "flac": "FLAC", "ogg": "OGG"}
+
+# Stands in for mp3val, flac and oggz-validate. Reads the file from stdin if
+# the only argument is `-` and sleeps for the configured latency.
+STUB_TOOL = """#!/bin/sh
+if [ "$1" = "-" ]; then cat > /dev/null; fi
+sleep {latency}
+"""
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m test.benchmark",
+        description="Benchmark beet check on a synthetic library.",
+    )
+    parser.add_argument(
+        "--items", type=int, default=500, help="number of items (default: 500)"
+    )
+    parser.add_argument(
+        "--size-median",
+        default="4M",
+        help="median file size, units are powers of 1024 (default: 4M)",
+    )
+    parser.add_argument(
+        "--size-sigma",
+        type=float,
+        default=0.5,
+        help="spread of the log-normal file size distribution (default: 0.5)",
+    )
+    parser.add_argument(
+        "--formats",
+        default="mp3,flac,ogg",
+        help="comma separated formats, repeat a format to weight it "
+        "(default: mp3,flac,ogg)",
+    )
+    parser.add_argument(
+        "--tool-latency",
+        type=float,
+        default=0.02,
+        help="seconds each stub tool takes per file (default: 0.02)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count(), help="check.threads"
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help=f"comma separated modes to run (default: {','.join(MODES)})",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="random seed for the library"
+    )
+    parser.add_argument(
+        "--directory",
+        help="directory for the library, kept after the run "
+        "(default: a temporary directory)",
+    )
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.child:
+        run_child(options.child, options.directory)
+        return
+
+    modes = options.modes.split(",")
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode}")
+    formats = options.formats.split(",")
+    for format in formats:
+        if format not in FORMATS:
+            parser.error(f"unknown format {format}")
+
+    with contextlib.ExitStack() as stack:
+        directory = options.directory
+        if not directory:
+            directory = stack.enter_context(tempfile.TemporaryDirectory())
+        setup_library(
+            directory,
+            items=options.items,
+            median=check.parse_size(options.size_median),
+            sigma=options.size_sigma,
+            formats=formats,
+            seed=options.seed,
+        )
+        setup_config(directory, options.threads, options.tool_latency)
+        results = [run_mode(mode, directory) for mode in modes]
+
+    report = {
+        "python": platform.python_version(),
+        "beets": beets.__version__,
+        "platform": platform.platform(),
+        "parameters": {
+            "items": options.items,
+            "size_median": options.size_median,
+            "size_sigma": options.size_sigma,
+            "formats": formats,
+            "tool_latency": options.tool_latency,
+            "threads": options.threads,
+            "seed": options.seed,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2) + "\n"
+    if options.output:
+        with open(options.output, "w") as file:  # noqa: FURB103
+            file.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def setup_library(directory, items, median, sigma, formats, seed):
+    """Create a library with `items` files whose sizes follow a log-normal
+    distribution around `median`.
+
+    The files have random content, so only checksums are meaningful. The
+    built-in checkers are disabled and the stub tools check the files.
+    """
+    rng = random.Random(seed)
+    libdir = os.path.join(directory, "libdir")
+    os.makedirs(libdir, exist_ok=True)
+    block = rng.randbytes(1024 * 1024)
+    lib = beets.library.Library(os.path.join(directory, "library.db"), libdir)
+    with lib.transaction():
+        for index in range(items):
+            format = rng.choice(formats)
+            size = max(int(rng.lognormvariate(0, sigma) * median), 1)
+            path = os.path.join(libdir, f"{index:06}.{format}")
+            with open(path, "wb") as file:
+                # A distinct header so that no two files are the same
+                file.write(index.to_bytes(8, "big"))
+                remaining = size - 8
+                while remaining > 0:
+                    file.write(block[: min(remaining, len(block))])
+                    remaining -= len(block)
+            item = Item(
+                path=bytestring_path(path),
+                format=FORMATS[format],
+                title=f"Track {index}",
+                artist=f"Artist {index % 50}",
+                album=f"Album {index % 200}",
+            )
+            lib.add(item)
+    lib._close()
+
+
+def setup_config(directory, threads, latency):
+    """Write the beets configuration with stub tools to `directory`."""
+    tools = os.path.join(directory, "tools")
+    os.makedirs(tools, exist_ok=True)
+    for name in ("mp3val", "flac", "oggz-validate"):
+        path = os.path.join(tools, name)
+        with open(path, "w") as file:  # noqa: FURB103
+            file.write(STUB_TOOL.format(latency=latency))
+        os.chmod(path, 0o755)
+    config = {
+        "directory": os.path.join(directory, "libdir"),
+        "library": os.path.join(directory, "library.db"),
+        "plugins": ["check"],
+        "check": {
+            "threads": threads,
+            "builtin": [],
+            "external": {
+                "mp3val": {
+                    "cmdline": f"{tools}/mp3val {{0}}",
+                    "fix": f"{tools}/mp3val {{0}}",
+                },
+                "flac": {
+                    "cmdline": f"{tools}/flac {{0}}",
+                    "stdin": f"{tools}/flac -",
+                    "fix": f"{tools}/flac {{0}}",
+                },
+                "oggz-validate": {"cmdline": f"{tools}/oggz-validate {{0}}"},
+            },
+        },
+    }
+    # JSON is valid YAML
+    with open(os.path.join(directory, "config.yaml"), "w") as file:
+        json.dump(config, file)
+
+
+def run_mode(mode, directory):
+    """Run the mode in a fresh interpreter and return its measurements.
+
+    A separate process gives each mode its own peak RSS.
+    """
+    print(f"running {mode}", file=sys.stderr)  # noqa: T201
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-m",
+            "test.benchmark",
+            "--child",
+            mode,
+            "--directory",
+            directory,
+        ],
+        env={**os.environ, "BEETSDIR": directory},
+    )
+    return json.loads(output)
+
+
+def run_child(mode, directory):
+    """Run the mode in this process and print the measurements as JSON."""
+    args = ["check", "--quiet", "--profile", *MODES[mode]]
+    files = size = 0
+    for entry in os.scandir(os.path.join(directory, "libdir")):
+        files += 1
+        size += entry.stat().st_size
+
+    stderr = io.StringIO()
+    code = 0
+    start = time.perf_counter()
+    with (
+        contextlib.redirect_stderr(stderr),
+        contextlib.redirect_stdout(io.StringIO()),
+    ):
+        try:
+            beets.ui._raw_main(args)
+        except SystemExit as exc:
+            code = exc.code
+    seconds = time.perf_counter() - start
+
+    phases = parse_profile(stderr.getvalue())
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+    json.dump(
+        {
+            "mode": mode,
+            "args": args[1:],
+            "exit_code": code,
+            "files": files,
+            "bytes": size,
+            "seconds": round(seconds, 3),
+            "files_per_second": round(files / seconds, 1),
+            "mb_per_second": round(size / seconds / 1024**2, 1),
+            "peak_rss_kb": peak_rss,
+            "db_seconds": round(phases.get("commit", 0), 3),
+            "query_seconds": round(phases.get("query", 0), 3),
+            "phases": phases,
+        },
+        sys.stdout,
+    )
+
+
+def parse_profile(text):
+    """Return the total seconds of each phase printed by `--profile`."""
+    phases = {}
+    lines = text.splitlines()
+    for index, line in enumerate(lines):
+        if line.split()[:1] == ["phase"]:
+            for row in lines[index + 1 :]:
+                fields = row.split()
+                if len(fields) < 5 or not fields[-4].endswith("s"):
+                    break
+                name = " ".join(fields[:-4])
+                phases[name] = round(float(fields[-4][:-1]), 3)
+            break
+    return phases
+
+
+if __name__ == "__main__":
+    main()
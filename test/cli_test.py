@@ -1,6 +1,20 @@
+import asyncio
+import contextlib
+import csv
+import json
 import os
+import pstats
+import queue
 import re
 import shutil
+import signal
+import stat
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from io import BytesIO, StringIO
 from unittest import TestCase
 
 import beets.library
@@ -9,8 +23,29 @@ import pytest
 from beets.library import Item
 from beets.ui import UserError
 
-from beetsplug.check import set_checksum, verify_checksum
-from test.helper import MockChecker, TestHelper, captureLog, captureStdout, controlStdin
+from beetsplug import _check_verify
+from beetsplug._check_hash import unescape_manifest_path
+from beetsplug.check import (
+    CheckCommand,
+    ItemWriter,
+    Progress,
+    compute_checksum,
+    format_duration,
+    format_labels,
+    format_size,
+    parse_manifest,
+    percentile,
+    set_checksum,
+    verify_checksum,
+)
+from test.helper import (
+    MockChecker,
+    TestHelper,
+    captureLog,
+    captureStderr,
+    captureStdout,
+    controlStdin,
+)
 
 
 class TestBase(TestHelper, TestCase):
@@ -84,6 +119,15 @@ class CheckTest(TestBase, TestCase):
             stdout.getvalue().split("\n")[-2] == "All checksums successfully verified"
         )
 
+    def test_check_with_small_read_buffer(self):
+        self.setupFixtureLibrary()
+        self.config["check"]["read_buffer"] = 7
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check"])
+        assert (
+            stdout.getvalue().split("\n")[-2] == "All checksums successfully verified"
+        )
+
     def test_check_failed_error_log(self):
         self.setupFixtureLibrary()
         item = self.lib.items().get()
@@ -120,6 +164,645 @@ class CheckTest(TestBase, TestCase):
         assert exc_info.value.code == 15
 
 
+class CheckQuickTest(TestBase, TestCase):
+    """beet check --quick"""
+
+    def test_skip_unchanged_file(self):
+        self.setupFixtureLibrary()
+        item = self.lib.items().get()
+        self.corruptFile(item.path)
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--quick"])
+        assert "All checksums successfully verified" in stdout.getvalue()
+
+        with pytest.raises(SystemExit) as exc_info:
+            beets.ui._raw_main(["check"])
+        assert exc_info.value.code == 15
+
+    def test_verify_changed_file(self):
+        self.setupFixtureLibrary()
+        item = self.lib.items().get()
+        self.modifyFile(item.path)
+
+        with pytest.raises(SystemExit) as exc_info, captureLog() as logs:
+            beets.ui._raw_main(["check", "--quick"])
+        assert exc_info.value.code == 15
+        assert "FAILED: {}".format(item.path.decode("utf-8")) in "\n".join(logs)
+
+    def test_record_missing_metadata(self):
+        self.setupFixtureLibrary()
+        item = self.lib.items().get()
+        del item["checksum_mtime"]
+        item.store()
+
+        beets.ui._raw_main(["check", "--quick"])
+
+        item = self.lib.items().get()
+        assert float(item["checksum_mtime"]) == os.stat(item.path).st_mtime
+
+    def test_update_changed_files_only(self):
+        self.setupFixtureLibrary()
+        unchanged, changed = list(self.lib.items())[:2]
+        unchanged["checksum"] = "stale"
+        unchanged.store()
+        orig_checksum = changed["checksum"]
+        self.modifyFile(changed.path)
+
+        beets.ui._raw_main(["check", "--update", "--quick", "--force"])
+
+        unchanged.load()
+        changed.load()
+        assert unchanged["checksum"] == "stale"
+        assert changed["checksum"] != orig_checksum
+        verify_checksum(changed)
+
+
+class CheckAlgorithmTest(TestBase, TestCase):
+    """check.algorithm and beet check --rehash-to"""
+
+    def test_add_with_algorithm(self):
+        self.config["check"]["algorithm"] = "blake2b"
+        item = self.addItemFixture("ok.ogg")
+
+        beets.ui._raw_main(["check", "-a"])
+
+        item.load()
+        assert item["checksum"].startswith("blake2b:")
+        verify_checksum(item)
+
+    def test_verify_with_stored_algorithm(self):
+        self.setupFixtureLibrary()
+        self.config["check"]["algorithm"] = "blake2b"
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check"])
+        assert "All checksums successfully verified" in stdout.getvalue()
+
+    def test_rehash(self):
+        self.setupFixtureLibrary()
+
+        beets.ui._raw_main(["check", "--rehash-to", "blake2b"])
+
+        for item in self.lib.items():
+            assert item["checksum"].startswith("blake2b:")
+            verify_checksum(item)
+
+    def test_rehash_keeps_wrong_checksum(self):
+        item = self.addCorruptedFixture()
+
+        with pytest.raises(SystemExit) as exc_info, captureLog() as logs:
+            beets.ui._raw_main(["check", "--rehash-to", "blake2b"])
+        assert exc_info.value.code == 15
+        assert "FAILED: {}".format(item.path.decode("utf-8")) in "\n".join(logs)
+
+        item.load()
+        assert item["checksum"] == "this is a wrong checksum"
+
+    def test_unsupported_algorithm(self):
+        with pytest.raises(UserError):
+            beets.ui._raw_main(["check", "--rehash-to", "md4"])
+
+
+class ItemWriterTest(TestBase, TestCase):
+    def test_store_in_batches(self):
+        self.setupFixtureLibrary()
+        items = list(self.lib.items())
+        with ItemWriter(self.lib, batch_size=2, interval=60) as writer:
+            for item in items:
+                item["checksum"] = "stored"
+                writer.store(item)
+
+        assert all(i["checksum"] == "stored" for i in self.lib.items())
+
+    def test_store_async_does_not_block_event_loop(self):
+        item = self.addItemFixture("ok.ogg")
+        busy = threading.Event()
+        release = threading.Event()
+
+        def block():
+            busy.set()
+            release.wait()
+
+        async def store(writer):
+            stored = asyncio.ensure_future(writer.store_async(item))
+            started = time.monotonic()
+            await asyncio.sleep(0.01)
+            assert time.monotonic() - started < 1
+            assert not stored.done()
+            release.set()
+            await stored
+
+        with ItemWriter(self.lib, batch_size=1, interval=0) as writer:
+            try:
+                writer.call(block)
+                busy.wait()
+                with contextlib.suppress(queue.Full):
+                    while True:
+                        writer._queue.put_nowait(item)
+                # Unblock the writer if `store_async` blocks the event loop
+                threading.Timer(2, release.set).start()
+                asyncio.run(store(writer))
+            finally:
+                release.set()
+
+    def test_raise_store_error(self):
+        item = Item(path="/not/in/library")
+
+        with (
+            pytest.raises(ValueError),  # noqa: PT011
+            ItemWriter(self.lib, batch_size=2, interval=60) as writer,
+        ):
+            writer.store(item)
+
+
+class ExecuteWithProgressTest(TestBase, TestCase):
+    def test_consume_arguments_lazily(self):
+        self.config["check"]["threads"] = 2
+        command = CheckCommand(self.config["check"])
+        command.quiet = True
+        consumed = []
+        started = []
+
+        def args():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        def func(i):
+            started.append(i)
+            assert len(consumed) - len(started) <= 4 * command.threads
+
+        command.execute_with_progress(func, args())
+        assert sorted(started) == list(range(100))
+
+    def test_limit_threads_per_device(self):
+        self.config["check"]["threads"] = 4
+        self.config["check"]["per_device_threads"] = 1
+        self.config["check"]["devices"] = ["/disk1", "/disk2"]
+        command = CheckCommand(self.config["check"])
+        command.quiet = True
+        lock = threading.Lock()
+        running = Counter()
+        max_running = Counter()
+
+        def func(item):
+            disk = item.path.split(b"/")[1]
+            with lock:
+                running[disk] += 1
+                max_running[disk] = max(max_running[disk], running[disk])
+            time.sleep(0.001)
+            with lock:
+                running[disk] -= 1
+
+        items = [Item(path=f"/disk{i % 2 + 1}/{i}.mp3") for i in range(20)]
+        command.execute_with_progress(func, items)
+        assert max_running == {b"disk1": 1, b"disk2": 1}
+
+
+class ProgressTest(TestBase, TestCase):
+    def test_line(self):
+        item = self.addItemFixture("ok.ogg")
+        size = os.path.getsize(item.path)
+        progress = Progress("Verifying checksums", total=4)
+        progress.start(item)
+        progress.finish(item)
+        progress.start(Item(path=b"/slow.mp3"))
+
+        line = progress.line()
+        assert line.startswith("Verifying checksums: 1/4 [25%], ")
+        assert format_size(size) in line
+        assert "/s, " in line
+        assert "files/s, ETA " in line
+        assert line.endswith("slowest 0s /slow.mp3")
+
+    def test_recorded_size(self):
+        item = Item(path=b"/missing.mp3", checksum_size="2048")
+        progress = Progress("Adding")
+        progress.finish(item)
+        assert progress.bytes == 2048
+        assert "ETA" not in progress.line()
+
+    def test_throttle_redraw(self):
+        out = StringIO()
+        progress = Progress("Adding", out=out, interval=60)
+        progress.finish(Item(path=b"/a.mp3"))
+        progress.draw()
+        progress.finish(Item(path=b"/b.mp3"))
+        progress.draw()
+        assert out.getvalue().count("\r") == 1
+        progress.close()
+        assert out.getvalue().count("\r") == 2
+        assert out.getvalue().endswith("\n")
+
+    def test_format(self):
+        assert format_size(512) == "512 B"
+        assert format_size(3 * 1024**3) == "3.0 GiB"
+        assert format_duration(7) == "7s"
+        assert format_duration(307) == "5m07s"
+        assert format_duration(3720) == "1h02m"
+
+
+class CheckOrderTest(TestBase, TestCase):
+    """beet check --order"""
+
+    def updated_paths(self, order, *query):
+        self.config["check"]["threads"] = 1
+        with captureLog("beets.check") as logs:
+            beets.ui._raw_main(["check", "-u", "-f", f"--order={order}", *query])
+        prefix = "check: updating checksum: "
+        return [line[len(prefix) :] for line in logs if line.startswith(prefix)]
+
+    def test_order_by_path(self):
+        self.setupFixtureLibrary()
+        paths = self.updated_paths("path")
+        assert len(paths) == len(os.listdir(self.fixture_dir))
+        assert paths == sorted(paths)
+
+    def test_order_by_inode(self):
+        self.setupFixtureLibrary()
+        paths = self.updated_paths("inode")
+        assert len(paths) == len(os.listdir(self.fixture_dir))
+        assert paths == sorted(paths, key=lambda p: os.stat(p).st_ino)
+
+    def test_order_by_extent(self):
+        self.setupFixtureLibrary()
+        paths = self.updated_paths("extent")
+        assert sorted(paths) == sorted(i.path.decode() for i in self.lib.items())
+
+    def test_order_by_db(self):
+        self.setupFixtureLibrary()
+        paths = self.updated_paths("db")
+        items = sorted(self.lib.items(), key=lambda i: i.id)
+        assert paths == [i.path.decode() for i in items]
+
+    def test_order_slow_query(self):
+        """Queries of flexible attributes load all items"""
+        self.setupFixtureLibrary()
+        paths = self.updated_paths("path", "checksum::.")
+        assert len(paths) == len(os.listdir(self.fixture_dir))
+        assert paths == sorted(paths)
+
+
+class CheckBudgetTest(TestBase, TestCase):
+    """beet check --budget-time / --budget-bytes"""
+
+    def addVerifiedFixture(self, basename, verified_at):
+        item = self.addItemFixture(basename)
+        set_checksum(item)
+        item["checksum_verified_at"] = str(verified_at)
+        item.store()
+        return item
+
+    def verified(self, item):
+        return self.lib.get_item(item.id)["checksum_verified_at"]
+
+    def test_record_verification_time(self):
+        item = self.addVerifiedFixture("ok.ogg", 1)
+        beets.ui._raw_main(["check"])
+        assert int(self.verified(item)) >= time.time() - 60
+
+    def test_failed_verification_not_recorded(self):
+        item = self.addCorruptedFixture()
+        item["checksum_verified_at"] = "1"
+        item.store()
+        with pytest.raises(SystemExit):
+            beets.ui._raw_main(["check"])
+        assert self.verified(item) == "1"
+
+    def test_new_checksum_is_verified(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        assert "checksum_verified_at" in item
+
+    def test_budget_bytes_oldest_first(self):
+        newer = self.addVerifiedFixture("ok.ogg", 2)
+        older = self.addVerifiedFixture("ok.flac", 1)
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--budget-bytes", "1"])
+        assert "Checked 1 of 2 file(s) within the budget" in stdout.getvalue()
+        assert self.verified(newer) == "2"
+        assert self.verified(older) != "1"
+
+    def test_verification_times_compared_as_numbers(self):
+        newer = self.addVerifiedFixture("ok.ogg", 10)
+        older = self.addVerifiedFixture("ok.flac", 9)
+
+        beets.ui._raw_main(["check", "--budget-bytes", "1"])
+        assert self.verified(newer) == "10"
+        assert self.verified(older) != "9"
+
+    def test_never_verified_first(self):
+        verified = self.addVerifiedFixture("ok.ogg", 1)
+        never = self.addItemFixture("ok.flac")
+        set_checksum(never)
+        del never["checksum_verified_at"]
+        never.store()
+
+        beets.ui._raw_main(["check", "--budget-bytes", "1K"])
+        assert self.verified(verified) == "1"
+        assert "checksum_verified_at" in self.lib.get_item(never.id)
+
+    def test_budget_time_spent(self):
+        item = self.addVerifiedFixture("ok.ogg", 1)
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--budget-time", "0s"])
+        assert "Checked 0 of 1 file(s) within the budget" in stdout.getvalue()
+        assert self.verified(item) == "1"
+
+    def test_budget_time(self):
+        self.addVerifiedFixture("ok.ogg", 1)
+        self.addVerifiedFixture("ok.flac", 2)
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--budget-time", "2h"])
+        assert "Checked 2 of 2 file(s) within the budget" in stdout.getvalue()
+
+    def test_invalid_budget(self):
+        with pytest.raises(UserError, match="invalid duration 2 hours"):
+            beets.ui._raw_main(["check", "--budget-time", "2 hours"])
+        with pytest.raises(UserError, match="invalid size 5X"):
+            beets.ui._raw_main(["check", "--budget-bytes", "5X"])
+
+    def test_budget_with_order(self):
+        with pytest.raises(UserError, match="--order=verified"):
+            beets.ui._raw_main(["check", "--budget-time", "1h", "--order", "path"])
+
+
+class CheckResumeTest(TestBase, TestCase):
+    """beet check --resume"""
+
+    def statePath(self):
+        return os.path.join(self.temp_dir, "check.resume")
+
+    def writeState(self, *checkpoints, command="check", query=()):
+        run = {
+            "command": command,
+            "library": self.config["library"].as_filename(),
+            "query": list(query),
+            "order": "db",
+            "quick": False,
+        }
+        with open(self.statePath(), "w") as file:
+            file.write(json.dumps(run, sort_keys=True) + "\n")
+            file.writelines(json.dumps(c) + "\n" for c in checkpoints)
+
+    def test_skip_checked_items(self):
+        self.setupFixtureLibrary()
+        corrupted = self.addCorruptedFixture()
+        self.writeState([[corrupted.id], 1])
+
+        with pytest.raises(SystemExit) as exc, captureLog() as logs:
+            beets.ui._raw_main(["check", "--resume"])
+        assert exc.value.code == 15
+        assert "FAILED" not in "\n".join(logs)
+        assert not os.path.exists(self.statePath())
+
+    def test_restart_different_run(self):
+        corrupted = self.addCorruptedFixture()
+        self.writeState([[corrupted.id], 0], query=["title:foo"])
+
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--resume"])
+        assert "FAILED" in "\n".join(logs)
+        assert not os.path.exists(self.statePath())
+
+    def test_ignore_incomplete_checkpoint(self):
+        item = self.addItemFixture("ok.ogg")
+        self.writeState([[item.id], 1])
+        with open(self.statePath(), "a") as file:
+            file.write("[[1, 2")
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--resume"])
+        assert "FAILED" not in "\n".join(logs)
+
+    def test_add_resume(self):
+        item = self.addItemFixture("ok.ogg")
+        self.writeState([[item.id], 0], command="add")
+        beets.ui._raw_main(["check", "--add", "--resume"])
+        assert "checksum" not in self.lib.get_item(item.id)
+        assert not os.path.exists(self.statePath())
+
+    def test_restore_signal_handler(self):
+        self.addItemFixture("ok.ogg")
+        original = signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            beets.ui._raw_main(["check", "--add", "--resume"])
+            assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+        finally:
+            signal.signal(signal.SIGTERM, original)
+
+    def test_checkpoint(self):
+        self.setupFixtureLibrary()
+        command = CheckCommand(self.config["check"])
+        command.lib = self.lib
+        command.query = []
+        command.order = "db"
+        command.quick = False
+        command.resume = True
+        with ItemWriter(self.lib, 100, 100) as command.writer:
+            items, _, _ = command.resumable("check", *command.items())
+            for item in items:
+                command.finished(item, 1)
+            command.checkpoint.flush()
+        with open(self.statePath()) as file:  # noqa: FURB101
+            lines = file.read().splitlines()
+        ids, failures = json.loads(lines[1])
+        assert sorted(ids) == sorted(item.id for item in self.lib.items())
+        assert failures == len(ids)
+
+    def test_call_after_commit(self):
+        item = self.addItemFixture("ok.ogg")
+        titles = []
+        with ItemWriter(self.lib, 100, 100) as writer:
+            item.title = "stored"
+            writer.store(item)
+            writer.call(lambda: titles.append(self.lib.get_item(item.id).title))
+        assert titles == ["stored"]
+
+    def test_resume_other_command(self):
+        with pytest.raises(UserError, match="--resume"):
+            beets.ui._raw_main(["check", "--export", "--resume"])
+
+
+class ReportTest(TestBase, TestCase):
+    """beet check --format=jsonl / --report"""
+
+    def readReport(self, path):
+        with open(path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_check_report(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        item.store()
+        corrupted = self.addCorruptedFixture()
+        path = os.path.join(self.temp_dir, "report.jsonl")
+
+        with pytest.raises(SystemExit):
+            beets.ui._raw_main(["check", "--report", path])
+
+        records = {r["id"]: r for r in self.readReport(path)}
+        assert records[item.id]["status"] == "ok"
+        assert records[item.id]["reason"] is None
+        assert records[item.id]["path"] == item.path.decode()
+        assert records[item.id]["bytes"] == os.path.getsize(item.path)
+        assert set(records[item.id]["durations"]) == {"open", "read", "hash"}
+        assert records[corrupted.id]["status"] == "failed"
+        assert records[corrupted.id]["reason"] == (
+            "checksum did not match value in library."
+        )
+
+    def test_jsonl_stdout(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        item.store()
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--format=jsonl"])
+        lines = stdout.getvalue().splitlines()
+        assert len(lines) == 1
+        assert json.loads(lines[0])["status"] == "ok"
+
+    def test_integrity_warning(self):
+        MockChecker.install()
+        item = self.addIntegrityFailFixture()
+
+        with captureStdout() as stdout, pytest.raises(SystemExit):
+            beets.ui._raw_main(["check", "--external", "--format=jsonl"])
+        record = json.loads(stdout.getvalue())
+        assert record["id"] == item.id
+        assert record["status"] == "warning"
+        assert record["reason"] == "file is corrupt"
+        assert record["checker"] == "mock"
+        assert record["bytes"] == 0
+
+    def test_add_report(self):
+        item = self.addItemFixture("ok.ogg")
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--add", "--format=jsonl"])
+        record = json.loads(stdout.getvalue())
+        assert record["id"] == item.id
+        assert record["status"] == "added"
+
+    def test_report_other_command(self):
+        with pytest.raises(UserError, match="can only be written"):
+            beets.ui._raw_main(["check", "--rehash-to", "sha256", "--format=jsonl"])
+
+
+class MetricsTest(TestBase, TestCase):
+    """beet check --metrics-file"""
+
+    def readMetrics(self, path):
+        with open(path) as file:  # noqa: FURB101
+            return file.read()
+
+    def test_check_metrics(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        item.store()
+        self.addCorruptedFixture()
+        path = os.path.join(self.temp_dir, "check.prom")
+
+        with pytest.raises(SystemExit):
+            beets.ui._raw_main(["check", "--metrics-file", path])
+
+        metrics = self.readMetrics(path)
+        size = os.path.getsize(item.path)
+        assert 'beets_check_files_total{command="check",status="ok"} 1' in metrics
+        assert 'beets_check_files_total{command="check",status="failed"} 1' in metrics
+        assert (
+            'beets_check_failures_total{command="check",type="checksum"} 1'
+        ) in metrics
+        assert f'beets_check_bytes_read_total{{command="check"}} {2 * size}' in (
+            metrics
+        )
+        assert (
+            'beets_check_hash_duration_seconds_bucket{command="check",le="+Inf"} 2'
+        ) in metrics
+        assert 'beets_check_run_duration_seconds{command="check"}' in metrics
+        assert os.listdir(self.temp_dir).count("check.prom") == 1
+        assert not [f for f in os.listdir(self.temp_dir) if f.endswith(".tmp")]
+
+    def test_metrics_file_readable_by_others(self):
+        path = os.path.join(self.temp_dir, "check.prom")
+        beets.ui._raw_main(["check", "--metrics-file", path])
+        mode = os.stat(path).st_mode
+        assert mode & stat.S_IRGRP
+        assert mode & stat.S_IROTH
+
+    def test_checker_histogram(self):
+        MockChecker.install()
+        self.addIntegrityFailFixture()
+        path = os.path.join(self.temp_dir, "check.prom")
+
+        with pytest.raises(SystemExit):
+            beets.ui._raw_main(["check", "--external", "--metrics-file", path])
+
+        metrics = self.readMetrics(path)
+        assert (
+            "beets_check_checker_duration_seconds_count"
+            '{command="external",checker="mock"} 1'
+        ) in metrics
+        assert (
+            'beets_check_failures_total{command="external",type="integrity"} 1'
+        ) in metrics
+
+    def test_format_labels(self):
+        assert format_labels({"a": 'x"y\\z', "le": 0.5}) == (
+            '{a="x\\"y\\\\z",le="0.5"}'
+        )
+
+
+class ProfileTest(TestBase, TestCase):
+    """beet check --profile"""
+
+    def test_print_phases(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        item.store()
+
+        with captureStderr() as stderr:
+            beets.ui._raw_main(["check", "--profile", "-u", "-f"])
+        lines = stderr.getvalue().splitlines()
+        assert lines[0].split() == ["phase", "total", "p50", "p99", "count"]
+        phases = {line.split()[0]: line.split()[-1] for line in lines[1:]}
+        assert phases["hash"] == "1"
+        assert phases["read"] == "1"
+        assert phases["store"] == "1"
+        assert phases["commit"] == "1"
+        assert phases["query"] == "2"
+
+    def test_subprocess_phases(self):
+        self.config["check"]["builtin"] = []
+        self.config["check"]["external"] = {
+            "true": {"cmdline": "true {}", "formats": "OGG"}
+        }
+        self.enableIntegrityCheckers()
+        self.addItemFixture("ok.ogg")
+
+        with captureStderr() as stderr:
+            beets.ui._raw_main(["check", "--external", "--profile"])
+        phases = [line.split()[0] for line in stderr.getvalue().splitlines()]
+        assert {"spawn", "wait", "true"} <= set(phases)
+
+    def test_dump_stats(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        item.store()
+        path = os.path.join(self.temp_dir, "check.pstats")
+
+        with captureStderr():
+            beets.ui._raw_main(["check", "--profile-dump", path])
+        stats = pstats.Stats(path)
+        assert any(func[2] == "hash_file" for func in stats.stats)
+
+    def test_percentile(self):
+        assert percentile([], 50) == 0
+        assert percentile([1, 2, 3, 4], 50) == 2
+        assert percentile(list(range(1, 101)), 99) == 99
+        assert percentile([5], 99) == 5
+
+
 class CheckIntegrityTest(TestBase, TestCase):
     # TODO beet check --external=mp3val,other
     """beet check --external"""
@@ -160,6 +843,109 @@ class CheckIntegrityTest(TestBase, TestCase):
         assert "Using integrity checker mock" in stdout.getvalue()
 
 
+class CheckAllTest(TestBase, TestCase):
+    """beet check --all"""
+
+    def test_checksum_and_integrity(self):
+        MockChecker.install()
+        self.addIntegrityFailFixture()
+        corrupted = self.addCorruptedFixture()
+        ok = self.addItemFixture("ok.flac")
+        set_checksum(ok)
+
+        with (
+            pytest.raises(SystemExit) as exc_info,
+            captureLog() as logs,
+            captureStdout() as stdout,
+        ):
+            beets.ui._raw_main(["check", "--all"])
+        assert exc_info.value.code == 15
+        assert "check: WARNING file is corrupt" in "\n".join(logs)
+        assert f"check: FAILED: {corrupted.path.decode()}" in logs
+        assert "Found 2 error(s)" in stdout.getvalue()
+
+    def test_no_read_without_checksum_and_stream(self):
+        MockChecker.install()
+        item = self.addItemFixture("ok.ogg")
+        path = os.path.join(self.temp_dir, "report.jsonl")
+
+        beets.ui._raw_main(["check", "--all", "--report", path])
+        with open(path) as file:
+            (record,) = [json.loads(line) for line in file]
+        assert record["id"] == item.id
+        assert record["bytes"] == 0
+
+    def test_success(self):
+        self.enableIntegrityCheckers()
+        self.config["check"]["external"] = {}
+        item = self.addItemFixture("ok.flac")
+        set_checksum(item)
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--all"])
+        assert "All checksums and integrity successfully verified" in stdout.getvalue()
+
+    def test_builtin_checker(self):
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = ["flac"]
+        item = self.addItemFixture("truncated.flac")
+        set_checksum(item)
+
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--all"])
+        assert any(
+            "WARNING frame CRC mismatch" in line and item.path.decode() in line
+            for line in logs
+        )
+        assert not any("FAILED" in line for line in logs)
+
+    def test_stdin_tool(self):
+        """Tools configured with `stdin` read the file from their input
+        instead of opening it again.
+        """
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = []
+        output = os.path.join(self.temp_dir, "stdin")
+        self.config["check"]["external"] = {
+            "cat": {
+                "cmdline": "false {0}",
+                "stdin": f"sh -c 'cat > {output}'",
+                "formats": "OGG",
+            }
+        }
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--all"])
+        assert "All checksums and integrity successfully verified" in stdout.getvalue()
+        with open(output, "rb") as out, open(item.path, "rb") as file:  # noqa: FURB101
+            assert out.read() == file.read()
+
+    def test_stdin_tool_fails(self):
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = []
+        self.config["check"]["external"] = {
+            "head": {
+                "cmdline": "true {0}",
+                "stdin": "sh -c 'head -c 10 > /dev/null; exit 1'",
+                "formats": "OGG",
+            }
+        }
+        self.config["check"]["read_buffer"] = 16
+        item = self.addItemFixture("ok.ogg")
+
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--all"])
+        assert (
+            f"check: WARNING non-zero exit code for head: {item.path.decode()}" in logs
+        )
+
+    def test_quick_not_supported(self):
+        with pytest.raises(UserError, match="--all cannot be combined with --quick"):
+            beets.ui._raw_main(["check", "--all", "--quick"])
+
+
 class CheckUpdateTest(TestBase, TestCase):
     """beet check --update"""
 
@@ -226,6 +1012,692 @@ class CheckExportTest(TestBase, TestCase):
             in stdout.getvalue()
         )
 
+    def addExportFixtures(self):
+        sha = self.addItemFixture("ok.ogg")
+        set_checksum(sha)
+        blake = self.addItemFixture("ok.mp3")
+        blake["checksum"] = "blake2b:abcd"
+        blake.store()
+        self.addItemFixture("ok.flac")
+        return sha, blake
+
+    def export(self, *args):
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--export", *args])
+        return stdout.getvalue()
+
+    def test_export_bsd(self):
+        sha, blake = self.addExportFixtures()
+        assert self.export("--format=bsd").splitlines() == [
+            f"SHA256 ({sha.path.decode()}) = {sha.checksum}",
+            f"BLAKE2b ({blake.path.decode()}) = abcd",
+        ]
+
+    def test_export_csv(self):
+        sha, blake = self.addExportFixtures()
+        rows = list(csv.reader(StringIO(self.export("--format=csv"))))
+        assert rows == [
+            ["id", "path", "algorithm", "checksum"],
+            [str(sha.id), sha.path.decode(), "sha256", sha.checksum],
+            [str(blake.id), blake.path.decode(), "blake2b", "abcd"],
+        ]
+
+    def test_export_jsonl_output(self):
+        _sha, blake = self.addExportFixtures()
+        path = os.path.join(self.temp_dir, "checksums.jsonl")
+        assert self.export("--format=jsonl", "--output", path) == ""
+        with open(path) as file:
+            records = [json.loads(line) for line in file]
+        assert records[1] == {
+            "id": blake.id,
+            "path": blake.path.decode(),
+            "algorithm": "blake2b",
+            "checksum": "abcd",
+        }
+
+    def test_export_query(self):
+        _sha, blake = self.addExportFixtures()
+        assert self.export("format:MP3").splitlines() == [
+            f"BLAKE2b ({blake.path.decode()}) = abcd"
+        ]
+
+    def test_export_round_trip(self):
+        """Paths are escaped like sha256sum does and checksums of other
+        algorithms use the BSD format, so that the manifest can be read back.
+        """
+        self.config["check"]["algorithm"] = "blake2b"
+        src = os.path.join(self.fixture_dir, "ok.ogg")
+        dst = os.path.join(self.libdir, "back\\slash\nnew line.ogg")
+        shutil.copy(src, dst)
+        item = Item.from_path(dst)
+        item.add(self.lib)
+        set_checksum(item)
+        sha = self.addItemFixture("ok.mp3")
+        sha["checksum"] = "ab" * 32
+        sha.store()
+
+        for format in ("sha256sum", "bsd"):
+            manifest = self.export(f"--format={format}").encode()
+            entries = list(parse_manifest(BytesIO(manifest)))
+            assert entries == [
+                (item.path, item["checksum"]),
+                (sha.path, sha["checksum"]),
+            ]
+
+    def test_export_id_query(self):
+        sha, _ = self.addExportFixtures()
+        assert self.export(f"id:{sha.id}").splitlines() == [
+            f"{sha.checksum} *{sha.path.decode()}"
+        ]
+
+    def test_export_slow_query(self):
+        sha, _blake = self.addExportFixtures()
+        sha["mood"] = "calm"
+        sha.store()
+        assert self.export("mood:calm").splitlines() == [
+            f"{sha.checksum} *{sha.path.decode()}"
+        ]
+
+    def test_export_format_without_export(self):
+        with pytest.raises(UserError, match="requires --export"):
+            beets.ui._raw_main(["check", "--format=csv"])
+
+
+class ImportManifestTest(TestBase, TestCase):
+    """beet check --import-manifest"""
+
+    def writeManifest(self, *lines):
+        path = os.path.join(self.temp_dir, "manifest.sha256")
+        with open(path, "wb") as file:
+            file.writelines(line + b"\n" for line in lines)
+        return path
+
+    def test_import_gnu_manifest(self):
+        item = self.addItemFixture("ok.ogg")
+        digest = compute_checksum(item)
+        path = self.writeManifest(
+            digest.encode() + b" *" + item.path,
+            b"0" * 64 + b"  /not/in/library.mp3",
+        )
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--import-manifest", path])
+        assert "Imported 1 checksum(s)" in stdout.getvalue()
+        assert "Skipped 1 file(s) not in the library" in stdout.getvalue()
+        item = self.lib.get_item(item.id)
+        assert item["checksum"] == digest
+        verify_checksum(item)
+
+    def test_export_and_import_non_utf8_path(self):
+        item = self.addItemFixture("ok.ogg")
+        path = os.path.join(self.libdir.encode(), b"caf\xe9's.ogg")
+        os.rename(item.path, path)
+        item.path = path
+        set_checksum(item)
+        digest = item["checksum"]
+        manifest = os.path.join(self.temp_dir, "manifest.sha256")
+
+        beets.ui._raw_main(["check", "--export", "--output", manifest])
+        with open(manifest, "rb") as file:  # noqa: FURB101
+            assert file.read() == digest.encode() + b" *" + path + b"\n"
+
+        del item["checksum"]
+        item.store()
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--import-manifest", manifest])
+        assert "Imported 1 checksum(s)" in stdout.getvalue()
+        assert self.lib.get_item(item.id)["checksum"] == digest
+
+    def test_import_bsd_manifest_relative_paths(self):
+        item = self.addItemFixture("ok.ogg")
+        path = self.writeManifest(
+            b"BLAKE2b (libdir/ok.ogg) = " + b"AB" * 64,
+            b"MD5 (libdir/ok.ogg) = " + b"0" * 32,
+            b"not a manifest line",
+        )
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--import-manifest", path])
+        assert "Skipped 2 invalid line(s)" in stdout.getvalue()
+        assert self.lib.get_item(item.id)["checksum"] == "blake2b:" + "ab" * 64
+
+    def test_rewrite_prefix(self):
+        item = self.addItemFixture("ok.ogg")
+        path = self.writeManifest(b"a" * 64 + b"  /archive/music/ok.ogg")
+
+        beets.ui._raw_main([
+            "check",
+            "--import-manifest",
+            path,
+            "--rewrite-prefix",
+            f"/archive/music={self.libdir}",
+        ])
+        assert self.lib.get_item(item.id)["checksum"] == "a" * 64
+
+    def test_keep_existing_checksum(self):
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+        checksum = item["checksum"]
+        path = self.writeManifest(b"a" * 64 + b"  " + item.path)
+
+        beets.ui._raw_main(["check", "--import-manifest", path])
+        assert self.lib.get_item(item.id)["checksum"] == checksum
+
+        beets.ui._raw_main(["check", "--import-manifest", path, "--force"])
+        item = self.lib.get_item(item.id)
+        assert item["checksum"] == "a" * 64
+        # The file metadata belonged to the old checksum
+        assert "checksum_size" not in item
+        assert "checksum_verified_at" not in item
+
+    def test_stat_missing_file(self):
+        item = self.addItemFixture("ok.ogg")
+        os.remove(item.path)
+        path = self.writeManifest(b"a" * 64 + b"  " + item.path)
+
+        with captureLog() as logs:
+            beets.ui._raw_main(["check", "--import-manifest", path, "--stat"])
+        assert "check: WARNING No such file or empty file: " in "\n".join(logs)
+        assert "checksum" not in self.lib.get_item(item.id)
+
+    def test_query(self):
+        ogg = self.addItemFixture("ok.ogg")
+        mp3 = self.addItemFixture("ok.mp3")
+        path = self.writeManifest(
+            b"a" * 64 + b"  " + ogg.path, b"b" * 64 + b"  " + mp3.path
+        )
+
+        beets.ui._raw_main(["check", "--import-manifest", path, "format:MP3"])
+        assert "checksum" not in self.lib.get_item(ogg.id)
+        assert self.lib.get_item(mp3.id)["checksum"] == "b" * 64
+
+    def test_unescape_path(self):
+        assert unescape_manifest_path(b"a\\nb\\\\c") == b"a\nb\\c"
+
+
+class VerifyManifestTest(TestBase, TestCase):
+    """beets-check-verify"""
+
+    def export(self, *args):
+        path = os.path.join(self.temp_dir, "manifest")
+        beets.ui._raw_main(["check", "--export", "--output", path, *args])
+        return path
+
+    def verify(self, *args):
+        with captureStdout() as stdout, captureStderr() as stderr:
+            try:
+                _check_verify.main(list(args))
+                code = 0
+            except SystemExit as exc:
+                code = exc.code
+        return code, stdout.getvalue(), stderr.getvalue()
+
+    def test_verify_export(self):
+        self.setupFixtureLibrary()
+        for format in ("sha256sum", "bsd", "jsonl"):
+            code, stdout, _ = self.verify(self.export(f"--format={format}"))
+            assert code == 0
+            assert stdout == "All checksums successfully verified\n"
+
+    def test_corrupt_and_missing_files(self):
+        ogg = self.addItemFixture("ok.ogg")
+        mp3 = self.addItemFixture("ok.mp3")
+        flac = self.addItemFixture("ok.flac")
+        for item in (ogg, mp3, flac):
+            set_checksum(item)
+        path = self.export()
+        self.corruptFile(ogg.path)
+        os.remove(mp3.path)
+
+        code, stdout, _ = self.verify(path, "--threads", "2")
+        assert code == 15
+        lines = stdout.splitlines()
+        assert f"FAILED: {ogg.path.decode()}" in lines
+        assert any(line.startswith("ERROR ") for line in lines)
+        assert lines[-1] == "Failed to verify checksum of 2 file(s)"
+
+    def test_root_and_rewrite_prefix(self):
+        item = self.addItemFixture("ok.ogg")
+        digest = compute_checksum(item)
+        path = os.path.join(self.temp_dir, "manifest.sha256")
+        with open(path, "wb") as file:
+            file.write(digest.encode() + b"  ok.ogg\n")
+            file.write(digest.encode() + b"  /archive/music/ok.ogg\n")
+            file.write(b"not a manifest line\n")
+
+        code, stdout, stderr = self.verify(
+            path, "--root", self.libdir, "--rewrite-prefix", f"/archive={self.temp_dir}"
+        )
+        assert code == 15
+        assert "ERROR " in stdout
+        assert "WARNING invalid manifest line 3" in stderr
+
+        code, stdout, stderr = self.verify(
+            path,
+            "--root",
+            self.libdir,
+            "--rewrite-prefix",
+            f"/archive/music={self.libdir}",
+        )
+        assert code == 15
+        assert "ERROR " not in stdout
+        assert stdout.splitlines()[-1] == "Failed to read 1 line(s) of the manifest"
+        assert "Skipped 1 invalid line(s)" in stderr
+
+    def test_no_files_in_manifest(self):
+        path = os.path.join(self.temp_dir, "manifest")
+        for lines in ([], [b"not a manifest line\n"], [b"abcd  unsupported.ogg\n"]):
+            with open(path, "wb") as file:
+                file.writelines(lines)
+            code, stdout, _ = self.verify(path)
+            assert code == 15
+            assert "All checksums successfully verified" not in stdout
+
+    def test_does_not_import_beets(self):
+        subprocess.check_call([
+            sys.executable,
+            "-c",
+            "import sys; from beetsplug import _check_verify; "
+            "assert 'beets' not in sys.modules",
+        ])
+
+    def test_run_as_module(self):
+        path = os.path.join(self.temp_dir, "manifest")
+        with open(path, "wb") as file:  # noqa: FURB103
+            file.write(b"not a manifest line\n")
+        process = subprocess.run(
+            [sys.executable, "-m", "beetsplug._check_verify", path],
+            capture_output=True,
+        )
+        assert process.returncode == 15
+
+
+class ExternalToolTest(TestBase, TestCase):
+    """beet check --external with custom tools"""
+
+    def setUp(self):
+        super().setUp()
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = []
+
+    def test_failing_tool(self):
+        self.config["check"]["external"] = {
+            "false": {"cmdline": "false {0}", "formats": "OGG"}
+        }
+        item = self.addItemFixture("ok.ogg")
+
+        with pytest.raises(SystemExit) as exc_info, captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert exc_info.value.code == 15
+        assert (
+            "check: WARNING non-zero exit code for false: {}".format(
+                item.path.decode("utf-8")
+            )
+            in logs
+        )
+
+    def test_non_utf8_path(self):
+        self.config["check"]["external"] = {
+            "test": {"cmdline": "test -f {0}", "formats": "OGG"}
+        }
+        item = self.addItemFixture("ok.ogg")
+        path = os.path.join(self.libdir.encode(), b"caf\xe9's.ogg")
+        os.rename(item.path, path)
+        item.path = path
+        item.store()
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+    def batchTool(self, script):
+        """Write a shell script that logs its invocations to a file."""
+        path = os.path.join(self.temp_dir, "batch-tool")
+        with open(path, "w") as file:  # noqa: FURB103
+            file.write(f'#!/bin/sh\necho "$#" >> {path}.log\n{script}')
+        os.chmod(path, 0o755)
+        self.config["check"]["external"] = {
+            "batch-tool": {
+                "cmdline": f"{path} {{0}}",
+                "formats": "OGG FLAC MP3",
+                "error": "^.*: ERROR (.*)$",
+                "batch": 100,
+            }
+        }
+        return path + ".log"
+
+    def test_batch(self):
+        invocations = self.batchTool(
+            "status=0\n"
+            'for f in "$@"; do case "$f" in\n'
+            '  *truncated*) echo "$f: ERROR file is broken"; status=1;;\n'
+            "esac; done\n"
+            "exit $status\n"
+        )
+        self.setupFixtureLibrary()
+
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+
+        warnings = sorted(line for line in logs if "WARNING" in line)
+        truncated = sorted(
+            i.path.decode() for i in self.lib.items() if b"truncated" in i.path
+        )
+        assert warnings == [f"check: WARNING file is broken: {p}" for p in truncated]
+        with open(invocations) as file:  # noqa: FURB101
+            assert file.read() == f"{len(os.listdir(self.fixture_dir))}\n"
+
+    def test_batch_waits_for_slow_tool(self):
+        invocations = self.batchTool("exit 0\n")
+        # Runs before the batch tool and keeps the MP3 files from joining the
+        # batch for longer than the event loop waits for a call to finish.
+        self.config["check"]["external"] = {
+            "slow": {"cmdline": "sleep 0.5", "formats": "MP3"},
+            **self.config["check"]["external"].get(),
+        }
+        for name in ("ok.ogg", "ok.mp3", "ok.flac"):
+            self.addItemFixture(name)
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+
+        assert "Integrity successfully verified" in stdout.getvalue()
+        with open(invocations) as file:  # noqa: FURB101
+            assert file.read() == "3\n"
+
+    def test_batch_unassigned_error(self):
+        self.batchTool(
+            '[ "$#" -gt 1 ] && echo "ERROR something failed" && exit 1\n'
+            'case "$1" in *truncated*) exit 1;; esac\n'
+        )
+        self.setupFixtureLibrary()
+
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+
+        warnings = [line for line in logs if "WARNING" in line]
+        assert len(warnings) == 3
+        assert all("truncated" in line for line in warnings)
+
+    def test_concurrent_tools(self):
+        self.config["check"]["external_concurrency"] = 3
+        self.config["check"]["external"] = {
+            "true": {"cmdline": "true {0}", "formats": "OGG FLAC MP3"}
+        }
+        self.setupFixtureLibrary()
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+
+class BuiltinCheckerTest(TestBase, TestCase):
+    """beet check --external with the built-in checkers"""
+
+    def setUp(self):
+        super().setUp()
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = ["flac", "mp3", "ogg"]
+        # Don't run external tools that happen to be installed
+        self.orig_path = os.environ["PATH"]
+        os.environ["PATH"] = self.temp_dir
+
+    def tearDown(self):
+        super().tearDown()
+        os.environ["PATH"] = self.orig_path
+
+    def test_flac_ok(self):
+        self.addItemFixture("ok.flac")
+        self.addItemFixture("md5.flac")
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+    def test_flac_frame_crc(self):
+        item = self.addItemFixture("crc.flac")
+        with pytest.raises(SystemExit) as exc_info, captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert exc_info.value.code == 15
+        assert (
+            "check: WARNING frame CRC mismatch in last frame, file may be "
+            f"truncated (offset 0x516c): {item.path.decode()}"
+        ) in logs
+
+    def test_flac_truncated_small_read_buffer(self):
+        self.config["check"]["read_buffer"] = 7
+        item = self.addItemFixture("truncated.flac")
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert any(
+            "WARNING frame CRC mismatch" in line and item.path.decode() in line
+            for line in logs
+        )
+
+    def test_not_flac(self):
+        item = self.addItemFixture("ok.flac")
+        with open(item.path, "r+b") as file:
+            file.write(b"RIFF")
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            f"check: WARNING not a FLAC stream (offset 0x0): {item.path.decode()}"
+            in logs
+        )
+
+    def test_disable(self):
+        self.config["check"]["builtin"] = []
+        self.addItemFixture("crc.flac")
+        with pytest.raises(UserError, match="No integrity checkers found"):
+            beets.ui._raw_main(["check", "--external"])
+
+    def test_mp3_ok(self):
+        self.addItemFixture("ok.mp3")
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+    def test_mp3_truncated(self):
+        item = self.addItemFixture("truncated.mp3")
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            "check: WARNING It seems that file is truncated or there is garbage "
+            f"at the end of the file (offset 0x1a9c): {item.path.decode()}"
+        ) in logs
+
+    def test_mp3_junk_between_frames(self):
+        item = self.addItemFixture("ok.mp3")
+        # Insert data after the first frame
+        self.editFile(item.path, lambda data: data[:0x943] + b"junk" + data[0x943:])
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            "check: WARNING MPEG stream error, resynchronized successfully "
+            f"(offset 0x943): {item.path.decode()}"
+        ) in logs
+
+    def test_mp3_xing_frame_count(self):
+        item = self.addItemFixture("ok.mp3")
+        # Turn the first frame into a Xing frame that claims 99 frames.
+        xing = 0x83E + 4 + 17
+        self.editFile(
+            item.path,
+            lambda data: (
+                data[:xing]
+                + b"Xing"
+                + (1).to_bytes(4, "big")
+                + (99).to_bytes(4, "big")
+                + data[xing + 12 :]
+            ),
+        )
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            "check: WARNING Wrong number of MPEG frames specified in Xing header "
+            f"(99 instead of 40) (offset 0x83e): {item.path.decode()}"
+        ) in logs
+
+    def test_mp3_id3v1_tag(self):
+        item = self.addItemFixture("ok.mp3")
+        self.editFile(item.path, lambda data: data + b"TAG" + bytes(125))
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+    def test_mp3_replaces_mp3val(self):
+        mp3val = os.path.join(self.temp_dir, "mp3val")
+        with open(mp3val, "w") as file:  # noqa: FURB103
+            file.write("#!/bin/sh\necho 'WARNING: \"$1\" (offset 0x0): broken'\n")
+        os.chmod(mp3val, 0o755)
+        self.addItemFixture("ok.mp3")
+
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+        self.config["check"]["builtin"] = ["flac"]
+        self.enableIntegrityCheckers()
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert any("WARNING broken" in line for line in logs)
+
+    def test_ogg_ok(self):
+        self.addItemFixture("ok.ogg")
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--external"])
+        assert "Integrity successfully verified" in stdout.getvalue()
+
+    def test_ogg_truncated(self):
+        item = self.addItemFixture("truncated.ogg")
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            "check: WARNING file is truncated, end of stream page missing "
+            f"(offset 0xfd1): {item.path.decode()}"
+        ) in logs
+
+    def test_ogg_page_crc(self):
+        item = self.addItemFixture("ok.ogg")
+        self.corruptFile(item.path)
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            f"check: WARNING page CRC mismatch (offset 0x2010): {item.path.decode()}"
+            in logs
+        )
+
+    def test_ogg_page_sequence(self):
+        item = self.addItemFixture("ok.ogg")
+        # Drop the third page
+        self.editFile(item.path, lambda data: data[:4042] + data[8208:])
+        with pytest.raises(SystemExit), captureLog() as logs:
+            beets.ui._raw_main(["check", "--external"])
+        assert (
+            "check: WARNING page sequence number 3 does not follow 1 "
+            f"(offset 0xfca): {item.path.decode()}"
+        ) in logs
+
+    def editFile(self, path, edit):
+        with open(path, "rb") as file:  # noqa: FURB101
+            data = file.read()
+        with open(path, "wb") as file:  # noqa: FURB103
+            file.write(edit(data))
+
+    def test_unknown_checker(self):
+        self.config["check"]["builtin"] = ["wav"]
+        with pytest.raises(UserError, match="unknown checker wav"):
+            beets.ui._raw_main(["check", "--external"])
+
+
+class IntegrityCacheTest(TestBase, TestCase):
+    """beet check --external with recorded results"""
+
+    def setUp(self):
+        super().setUp()
+        self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = []
+        self.log = os.path.join(self.temp_dir, "tool.log")
+
+    def tool(self, exit_code=0):
+        path = os.path.join(self.temp_dir, "tool")
+        with open(path, "w") as file:  # noqa: FURB103
+            file.write(f'#!/bin/sh\necho "$1" >> {self.log}\nexit {exit_code}\n')
+        os.chmod(path, 0o755)
+        self.config["check"]["external"] = {
+            "tool": {"cmdline": f"{path} {{0}}", "formats": "OGG"}
+        }
+
+    def invocations(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as file:
+            return len(file.readlines())
+
+    def test_skip_unchanged(self):
+        self.tool()
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        beets.ui._raw_main(["check", "--external"])
+        beets.ui._raw_main(["check", "--external"])
+        assert self.invocations() == 1
+        item = self.lib.get_item(item.id)
+        assert "tool" in item["integrity_verdicts"]
+
+    def test_rerun_modified_file(self):
+        self.tool()
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        beets.ui._raw_main(["check", "--external"])
+        self.modifyFile(item.path)
+        beets.ui._raw_main(["check", "--external"])
+        assert self.invocations() == 2
+
+    def test_rerun_changed_tool(self):
+        self.tool()
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        beets.ui._raw_main(["check", "--external"])
+        self.config["check"]["external"]["tool"]["cmdline"] = (
+            f"{self.temp_dir}/tool --strict {{0}}"
+        )
+        self.enableIntegrityCheckers()
+        beets.ui._raw_main(["check", "--external"])
+        assert self.invocations() == 2
+
+    def test_force(self):
+        self.tool()
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        beets.ui._raw_main(["check", "--external"])
+        beets.ui._raw_main(["check", "--external", "--force"])
+        assert self.invocations() == 2
+
+    def test_cached_failure(self):
+        self.tool(exit_code=1)
+        item = self.addItemFixture("ok.ogg")
+        set_checksum(item)
+
+        for _ in range(2):
+            with pytest.raises(SystemExit), captureLog() as logs:
+                beets.ui._raw_main(["check", "--external"])
+            assert (
+                f"check: WARNING non-zero exit code for tool: {item.path.decode()}"
+                in logs
+            )
+        assert self.invocations() == 1
+
+    def test_no_checksum(self):
+        self.tool()
+        self.addItemFixture("ok.ogg")
+
+        beets.ui._raw_main(["check", "--external"])
+        beets.ui._raw_main(["check", "--external"])
+        assert self.invocations() == 2
+
 
 class IntegrityCheckTest(TestHelper, TestCase):
     """beet check --external
@@ -237,6 +1709,7 @@ class IntegrityCheckTest(TestHelper, TestCase):
         self.setupBeets()
         self.setupFixtureLibrary()
         self.enableIntegrityCheckers()
+        self.config["check"]["builtin"] = []
 
     def tearDown(self):
         super().tearDown()
@@ -396,6 +1869,17 @@ class ToolListTest(TestHelper, TestCase):
         assert "mp3val" in stdout.getvalue()
         assert "flac" in stdout.getvalue()
         assert "oggz-validate" in stdout.getvalue()
+        assert re.search(r"mp3 \(built-in\) *found", stdout.getvalue())
+        assert re.search(r"ogg \(built-in\) *found", stdout.getvalue())
+        assert "flac (built-in)" not in stdout.getvalue()
+
+    def test_list_builtin(self):
+        self.config["check"]["builtin"] = ["flac", "mp3", "ogg"]
+        with captureStdout() as stdout:
+            beets.ui._raw_main(["check", "--list-tools"])
+        assert re.search(r"flac \(built-in\) *found", stdout.getvalue())
+        assert re.search(r"mp3 \(built-in\) *found", stdout.getvalue())
+        assert re.search(r"ogg \(built-in\) *found", stdout.getvalue())
 
     def test_found_mp3val(self):
         shutil.copy("/bin/echo", os.path.join(self.temp_dir, "mp3val"))
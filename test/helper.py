@@ -65,6 +65,16 @@ def captureStdout():
         sys.stdout = org
 
 
+@contextmanager
+def captureStderr():
+    org = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        yield sys.stderr
+    finally:
+        sys.stderr = org
+
+
 @contextmanager
 def controlStdin(input=None):
     org = sys.stdin
@@ -171,6 +181,16 @@ class TestHelper:
         mediafile.title = title
         mediafile.save()
 
+    def corruptFile(self, path):
+        """Flip the last byte of the file without changing its metadata."""
+        stat = os.stat(path)
+        with open(path, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            byte = file.read(1)
+            file.seek(-1, os.SEEK_END)
+            file.write(bytes([byte[0] ^ 0xFF]))
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
     @contextmanager
     def mockAutotag(self):
         mock = AutotagMock()